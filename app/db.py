@@ -1,13 +1,56 @@
 import os
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
 
+from services.metrics import instrument_engine, pool_options
+
 DB_USER = os.getenv("DB_USER")
 DB_PASSWORD = os.getenv("DB_PASSWORD")
 DB_HOST = os.getenv("DB_HOST")
 DB_NAME = os.getenv("DB_NAME")
 
-DATABASE_URL = f"mysql+pymysql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}/{DB_NAME}"
+# DATABASE_URL / ASYNC_DATABASE_URL override the URLs built from the DB_* settings
+# (e.g. a local SQLite file for benchmarks).
+DATABASE_URL = os.getenv("DATABASE_URL", f"mysql+pymysql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}/{DB_NAME}")
+
+# Async driver for the query endpoints: asyncmy (default) or aiomysql.
+DB_ASYNC_DRIVER = os.getenv("DB_ASYNC_DRIVER", "asyncmy")
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL", f"mysql+{DB_ASYNC_DRIVER}://{DB_USER}:{DB_PASSWORD}@{DB_HOST}/{DB_NAME}")
+
+# Connection pool settings shared by both engines.
+POOL_OPTIONS = {
+    "pool_size": int(os.getenv("DB_POOL_SIZE", "5")),
+    "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "10")),
+    "pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "true").lower() == "true",
+    "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "3600")),
+}
+
+# Allow LOAD DATA LOCAL INFILE for the bulk insert fast path.
+LOCAL_INFILE = os.getenv("DB_LOCAL_INFILE", "false").lower() == "true"
 
-engine = create_engine(DATABASE_URL)
+engine = create_engine(DATABASE_URL, connect_args={"local_infile": True} if LOCAL_INFILE else {}, **POOL_OPTIONS, **pool_options())
+instrument_engine(engine, "sync")
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+async_engine = create_async_engine(ASYNC_DATABASE_URL, **POOL_OPTIONS, **pool_options(async_engine=True))
+instrument_engine(async_engine.sync_engine, "async")
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+def ping():
+    """Runs SELECT 1 on a pooled connection; raises SQLAlchemyError if the database is unreachable."""
+    with engine.connect() as connection:
+        connection.exec_driver_sql("SELECT 1")
+
+def get_db():
+    """FastAPI dependency yielding a synchronous session."""
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+async def get_async_db():
+    """FastAPI dependency yielding an async session."""
+    async with AsyncSessionLocal() as db:
+        yield db
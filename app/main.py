@@ -1,62 +1,238 @@
 # main.py
-from fastapi import FastAPI, HTTPException, Depends
+from datetime import datetime
+from typing import List, Optional
+from fastapi import BackgroundTasks, FastAPI, Form, Header, HTTPException, Depends, Query, Request, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy.orm import Session
-from database import get_db
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from db import engine
+from db import async_engine, engine, get_async_db, ping
 from models import Base
-from services.table_utils import check_required_tables, create_missing_tables
-from services.csv_processor import process_csv_file
-from services.backup_service import backup_all_tables
-from services.restore_service import restore_table_from_avro
-from services.query1 import fetch_hired_employees_per_quarter
-from services.query2 import fetch_departments_above_mean_hires
+from services.table_utils import (
+    create_missing_tables, ensure_hired_at_column, invalidate_required_tables, required_tables_status,
+)
+from services.csv_processor import process_upload
+from services.hires_summary import rebuild_hires_summary
+from services.executors import shutdown_executors
+from services.idempotency import claim_request, complete_request, create_idempotency_table, release_request
+from services.table_rewrites import create_rewrites_table
+from services.ingest_jobs import get_job, start_ingest_workers, stop_ingest_workers, submit_s3, submit_upload
+from services.backup_service import BACKUP_TABLES, backup_all_tables, check_backup_codec
+from services.restore_service import create_restores_table, get_restore, new_restore, restore_table_from_avro, restore_tables
+from services import analytics, query1, query2
+from services.report_cache import cached_report
+from services.metrics import METRICS_ENABLED, render_metrics
+from services.report_stream import STREAM_FORMATS, decode_cursor, encode_cursor, streaming_report
 
 app = FastAPI()
 
 @app.on_event("startup")
 def on_startup():
+    check_backup_codec()
     try:
-        tables_exist, missing = check_required_tables(engine)
+        tables_exist, missing = required_tables_status(engine, refresh=True)
         if not tables_exist:
             create_missing_tables(engine)
+        backfilled = ensure_hired_at_column(engine)
+        if backfilled or (not tables_exist and "hires_summary" in missing):
+            with engine.begin() as connection:
+                rebuild_hires_summary(connection)
+        if not tables_exist:
+            # Cache the check now that the tables exist.
+            required_tables_status(engine, refresh=True)
+        create_idempotency_table()
+        create_rewrites_table()
+        create_restores_table()
     except SQLAlchemyError as e:
         raise RuntimeError(f"Database startup error: {e}")
 
+@app.on_event("startup")
+async def on_startup_workers():
+    start_ingest_workers()
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await stop_ingest_workers()
+    shutdown_executors()
+    await async_engine.dispose()
+
 @app.get("/")
 def read_root():
+    """Reports whether the required tables exist (checked once, then cached)."""
     try:
-        tables_exist, missing = check_required_tables(engine)
+        tables_exist, missing = required_tables_status(engine)
         if not tables_exist:
             raise HTTPException(status_code=500, detail=f"Missing tables: {', '.join(missing)}")
         return {"message": "All required tables exist"}
     except SQLAlchemyError as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/livez")
+def liveness():
+    """Liveness probe: the process is up and serving requests. Touches nothing else."""
+    return {"status": "ok"}
+
+@app.get("/readyz")
+def readiness():
+    """
+    Readiness probe: a SELECT 1 on a pooled connection plus the cached schema
+    check. A failed query also drops the cached schema result, so the tables
+    are inspected again once the database is back.
+    """
+    try:
+        ping()
+        tables_exist, missing = required_tables_status(engine)
+    except SQLAlchemyError as e:
+        invalidate_required_tables()
+        raise HTTPException(status_code=503, detail=f"Database unavailable: {e}")
+    if not tables_exist:
+        raise HTTPException(status_code=503, detail=f"Missing tables: {', '.join(missing)}")
+    return {"status": "ready"}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """
+    Pipeline stage timings, row and byte counters, pool checkout waits and
+    query timings in Prometheus text format. Enabled with METRICS_ENABLED=true.
+    """
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
 @app.post("/upload_csv")
-async def upload_csv(file: UploadFile):
-    return await process_csv_file(file)
+async def upload_csv(
+    file: UploadFile,
+    stream: bool = False,
+    batch_size: Optional[int] = Query(None, gt=0),
+    mode: str = "insert",
+    first_row: int = Query(1, gt=0),
+    idempotency_key: Optional[str] = Header(None, max_length=128),
+):
+    """
+    Validates and inserts a CSV file. With stream=true the file is processed
+    in batches of batch_size rows and has no row limit.
+    The file may be gzip (.csv.gz) or zstd (.csv.zst) compressed, or a .zip
+    archive of several table files, loaded lookups first.
+    mode is one of insert, upsert (update existing ids) or replace (reload the
+    whole table through a shadow table swap).
+    first_row numbers the rows in error messages when the file is one batch
+    of a larger file.
+    With an Idempotency-Key header the upload is processed once: repeating
+    the key returns the stored response (and writes no new error file), and
+    a repeat sent while the first is still running gets a 409.
+    """
+    if idempotency_key is None:
+        return await process_upload(file, stream=stream, batch_size=batch_size, mode=mode, first_row=first_row)
+    stored = await run_in_threadpool(claim_request, idempotency_key)
+    if stored is not None:
+        return stored
+    try:
+        result = await process_upload(file, stream=stream, batch_size=batch_size, mode=mode, first_row=first_row)
+    except Exception:
+        await run_in_threadpool(release_request, idempotency_key)
+        raise
+    await run_in_threadpool(complete_request, idempotency_key, result)
+    return result
+
+@app.post("/ingest_jobs", status_code=202)
+async def create_ingest_job(
+    file: Optional[UploadFile] = None,
+    s3_key: Optional[str] = Form(None),
+    mode: str = Form("insert"),
+    batch_size: Optional[int] = Form(None, gt=0),
+):
+    """
+    Queues a CSV ingest that runs in the background, from either an uploaded
+    file or the key of an object in the raw data bucket. Rows are streamed
+    in batches as with /upload_csv?stream=true.
+    Returns the job id to poll at GET /ingest_jobs/{job_id}.
+    """
+    if (file is None) == (s3_key is None):
+        raise HTTPException(status_code=400, detail="Provide either a file or an s3_key")
+    if file is not None:
+        job_id = await submit_upload(file, mode, batch_size)
+    else:
+        job_id = await submit_s3(s3_key, mode, batch_size)
+    return {"job_id": job_id, "status": "queued"}
+
+@app.get("/ingest_jobs/{job_id}")
+def ingest_job_status(job_id: str):
+    """Returns the status of an ingest job: rows processed, throughput and errors."""
+    job = get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Ingest job not found")
+    return job
 
 @app.get("/backup")
-def backup_data():
+def backup_data(incremental: bool = False):
     """
     Backs up all tables into Avro files and uploads them to AWS S3.
-    Returns the S3 URLs of the stored backups.
+    With incremental=true only rows added since the previous backup are exported.
+    Returns the backup manifest listing every part file.
     """
     try:
-        backup_files = backup_all_tables()
-        return {"message": "Backup completed", "files": backup_files}
+        manifest = backup_all_tables(incremental=incremental)
+        analytics.invalidate_snapshot()
+        return {"message": "Backup completed", "manifest": manifest}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Backup failed: {e}")
 
+@app.post("/analytics/snapshot")
+def build_analytics_snapshot():
+    """
+    Converts the latest backup into Parquet snapshots for the analytics report
+    backend and loads them. Otherwise the first analytics report after a new
+    backup starts the build in the background and is answered from the
+    previous snapshot meanwhile. Joins a build that is already running.
+    """
+    try:
+        return {"message": "Snapshot built", **analytics.start_snapshot_build().result()}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Snapshot failed: {e}")
+
+@app.post("/restore", status_code=202)
+def restore_many(
+    background_tasks: BackgroundTasks,
+    tables: Optional[List[str]] = Query(None),
+    point_in_time: Optional[datetime] = None,
+    defer_checks: bool = False,
+):
+    """
+    Restores several tables (all by default) from their Avro backups at once,
+    loading every part file in parallel. Runs in the background; poll
+    GET /restore/{restore_id} for per-part progress.
+    defer_checks=true turns off foreign-key and unique checks while loading.
+    """
+    invalid = [t for t in tables or [] if t not in BACKUP_TABLES]
+    if invalid:
+        raise HTTPException(status_code=400, detail=f"Invalid table name: {', '.join(invalid)}")
+    restore_id = new_restore(tables)
+    background_tasks.add_task(_run_restore, tables, point_in_time, defer_checks, restore_id)
+    return {"message": "Restore started", "restore_id": restore_id}
+
+def _run_restore(tables, point_in_time, defer_checks, restore_id):
+    try:
+        restore_tables(tables, point_in_time, defer_checks, restore_id)
+    except (ValueError, RuntimeError) as e:
+        print(f"Restore {restore_id} failed: {e}")
+
+@app.get("/restore/{restore_id}")
+def restore_status(restore_id: str):
+    """Returns the progress of a bulk restore, part by part."""
+    progress = get_restore(restore_id)
+    if progress is None:
+        raise HTTPException(status_code=404, detail="Restore not found")
+    return progress
+
 @app.post("/restore/{table_name}")
-def restore_data(table_name: str):
+def restore_data(table_name: str, point_in_time: Optional[datetime] = None):
     """
-    Restores a specific table from its Avro backup stored in AWS S3.
+    Restores a specific table from its Avro backups stored in AWS S3, as of
+    point_in_time if given (full backup plus incremental backups up to then).
     """
     try:
-        message = restore_table_from_avro(table_name)
+        message = restore_table_from_avro(table_name, point_in_time)
         return {"message": message}
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -64,27 +240,130 @@ def restore_data(table_name: str):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def _check_format(format: str, backend: str = "database"):
+    if format != "json" and format not in STREAM_FORMATS:
+        raise HTTPException(status_code=400, detail="Invalid format. Expected one of: json, " + ", ".join(STREAM_FORMATS))
+    if backend not in analytics.REPORT_BACKENDS:
+        raise HTTPException(status_code=400, detail="Invalid backend. Expected one of: " + ", ".join(analytics.REPORT_BACKENDS))
+
+
+async def _analytics_report(request: Request, endpoint: str, params: dict, format: str, fieldnames, compute):
+    """
+    Answers a report from the columnar snapshot of the latest backup instead
+    of the database. compute(snapshot) returns the rows, or the JSON body.
+    """
+    try:
+        snapshot = await run_in_threadpool(analytics.current_snapshot)
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"Analytics backend unavailable: {e}")
+    try:
+        if format != "json":
+            rows = await run_in_threadpool(compute, snapshot)
+            return streaming_report(analytics.iter_rows(rows), format, fieldnames, f"{endpoint}_{params['year']}")
+        return await cached_report(
+            request, endpoint, {**params, "backend": "analytics", "snapshot": snapshot.backup_id},
+            lambda: run_in_threadpool(compute, snapshot),
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error retrieving data: {str(e)}")
+
+
 @app.get("/employees_hired_per_quarter")
-def get_employees_hired_per_quarter(db: Session = Depends(get_db)):
+async def get_employees_hired_per_quarter(
+    request: Request,
+    year: int = Query(2021, ge=1, lt=9999),
+    limit: Optional[int] = Query(None, gt=0, le=10000),
+    cursor: Optional[str] = None,
+    format: str = "json",
+    backend: str = "database",
+    db: AsyncSession = Depends(get_async_db),
+):
     """
-    Endpoint to retrieve the number of employees hired in 2021 by quarter,
-    grouped by department and job, sorted alphabetically.
+    Endpoint to retrieve the number of employees hired in the given year
+    (2021 by default) by quarter, grouped by department and job, sorted alphabetically.
+    Results are cached until the data changes and support If-None-Match.
+
+    With limit the response is one page, {"items": [...], "next_cursor": ...};
+    pass next_cursor back as cursor for the next page. format=ndjson or csv
+    streams every row (after cursor, if given) as it is read from the database.
+    backend=analytics answers from a columnar snapshot of the latest backup
+    instead, leaving the database alone.
     """
+    _check_format(format, backend)
     try:
-        result = fetch_hired_employees_per_quarter(db)
-        return result
+        after = decode_cursor(cursor, 2) if cursor else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    if backend == "analytics":
+        def compute(snapshot):
+            items = analytics.hired_employees_per_quarter(snapshot, year, after)
+            if format != "json" or (limit is None and after is None):
+                return items
+            page = items[:limit or 1000]
+            next_after = (page[-1]["department"], page[-1]["job"]) if len(items) > len(page) else None
+            return {"items": page, "next_cursor": encode_cursor(next_after) if next_after else None}
+
+        return await _analytics_report(
+            request, "employees_hired_per_quarter", {"year": year, "limit": limit, "cursor": cursor},
+            format, query1.FIELDNAMES, compute,
+        )
+
+    if format != "json":
+        rows = query1.stream_hired_employees_per_quarter(year, after)
+        return streaming_report(rows, format, query1.FIELDNAMES, f"employees_hired_per_quarter_{year}")
+
+    try:
+        if limit is None and after is None:
+            return await cached_report(
+                request, "employees_hired_per_quarter", {"year": year},
+                lambda: query1.fetch_hired_employees_per_quarter_async(db, year),
+            )
+
+        async def fetch_page():
+            items, next_after = await query1.fetch_hired_employees_per_quarter_page_async(
+                db, year, limit or 1000, after
+            )
+            return {"items": items, "next_cursor": encode_cursor(next_after) if next_after else None}
+
+        return await cached_report(
+            request, "employees_hired_per_quarter", {"year": year, "limit": limit, "cursor": cursor},
+            fetch_page,
+        )
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error retrieving data: {str(e)}")
 
 
 @app.get("/departments_above_mean_hires")
-def get_departments_above_mean_hires(db: Session = Depends(get_db)):
+async def get_departments_above_mean_hires(
+    request: Request,
+    year: int = Query(2021, ge=1, lt=9999),
+    format: str = "json",
+    backend: str = "database",
+    db: AsyncSession = Depends(get_async_db),
+):
     """
-    Endpoint to retrieve departments that hired more employees than the average in 2021,
-    ordered by the number of employees hired in descending order.
+    Endpoint to retrieve departments that hired more employees than the average
+    in the given year (2021 by default), ordered by the number of employees hired
+    in descending order.
+    Results are cached until the data changes and support If-None-Match;
+    format=ndjson or csv streams the rows instead.
+    backend=analytics answers from a columnar snapshot of the latest backup.
     """
+    _check_format(format, backend)
+    if backend == "analytics":
+        return await _analytics_report(
+            request, "departments_above_mean_hires", {"year": year}, format, query2.FIELDNAMES,
+            lambda snapshot: analytics.departments_above_mean_hires(snapshot, year),
+        )
+    if format != "json":
+        rows = query2.stream_departments_above_mean_hires(year)
+        return streaming_report(rows, format, query2.FIELDNAMES, f"departments_above_mean_hires_{year}")
+
     try:
-        result = fetch_departments_above_mean_hires(db)
-        return result
+        return await cached_report(
+            request, "departments_above_mean_hires", {"year": year},
+            lambda: query2.fetch_departments_above_mean_hires_async(db, year),
+        )
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error retrieving data: {str(e)}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Error retrieving data: {str(e)}")
@@ -1,6 +1,6 @@
 # models.py
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String
+from sqlalchemy import Column, DateTime, Index, Integer, String, Text
 
 Base = declarative_base()
 
@@ -9,9 +9,14 @@ class HiredEmployee(Base):
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String(255), nullable=False)
     datetime = Column(String(255), nullable=False)  # Stored as ISO string
+    hired_at = Column(DateTime, nullable=True)  # Parsed from datetime, in UTC
     department_id = Column(Integer, nullable=False)
     job_id = Column(Integer, nullable=False)
 
+    __table_args__ = (
+        Index("ix_hired_employees_hired_at_department_job", "hired_at", "department_id", "job_id"),
+    )
+
 class Department(Base):
     __tablename__ = "departments"
     id = Column(Integer, primary_key=True, index=True)
@@ -21,3 +26,60 @@ class Job(Base):
     __tablename__ = "jobs"
     id = Column(Integer, primary_key=True, index=True)
     job = Column(String(255), nullable=False)
+
+class HiresSummary(Base):
+    """Hire counts per (year, quarter, department, job), maintained by ingest and restore."""
+    __tablename__ = "hires_summary"
+    year = Column(Integer, primary_key=True)
+    quarter = Column(Integer, primary_key=True)
+    department_id = Column(Integer, primary_key=True)
+    job_id = Column(Integer, primary_key=True)
+    hires = Column(Integer, nullable=False)
+
+class DataVersion(Base):
+    """Single-row counter bumped whenever report data changes; shared by all API workers."""
+    __tablename__ = "data_version"
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
+
+class TableRewrite(Base):
+    """Per-table count of changes an id watermark cannot see (overwrites, replaces, restores)."""
+    __tablename__ = "table_rewrites"
+    table_name = Column(String(64), primary_key=True)
+    rewrites = Column(Integer, nullable=False)
+
+class IngestJob(Base):
+    """Queued CSV ingest run in the background by the ingest job workers."""
+    __tablename__ = "ingest_jobs"
+    id = Column(String(32), primary_key=True)
+    file_name = Column(String(255), nullable=False)
+    source = Column(String(16), nullable=False)  # "upload" or "s3"
+    location = Column(String(1024), nullable=False)  # spooled file path or S3 key
+    mode = Column(String(16), nullable=False)
+    batch_size = Column(Integer, nullable=True)
+    status = Column(String(16), nullable=False, index=True)  # queued, running, done or failed
+    rows_processed = Column(Integer, nullable=False, default=0)
+    inserted_rows = Column(Integer, nullable=False, default=0)
+    error_rows = Column(Integer, nullable=False, default=0)
+    error_file = Column(String(1024), nullable=True)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, nullable=False)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    heartbeat_at = Column(DateTime, nullable=True)  # Refreshed while a worker runs the job
+
+class RestoreRun(Base):
+    """Progress of a bulk restore, readable by every API worker."""
+    __tablename__ = "restores"
+    id = Column(String(32), primary_key=True)
+    status = Column(String(16), nullable=False)  # queued, running, done or failed
+    progress = Column(Text, nullable=False)  # JSON progress record, part by part
+    updated_at = Column(DateTime, nullable=False, index=True)
+
+class IngestRequest(Base):
+    """Result of an upload sent with an Idempotency-Key, replayed when the key is sent again."""
+    __tablename__ = "ingest_requests"
+    key = Column(String(128), primary_key=True)
+    status = Column(String(16), nullable=False)  # running or done
+    result = Column(Text, nullable=True)  # JSON response body once done
+    created_at = Column(DateTime, nullable=False, index=True)
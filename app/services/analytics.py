@@ -0,0 +1,288 @@
+# services/analytics.py
+import os
+import tempfile
+import threading
+import time
+import unicodedata
+
+from db import engine
+from services.aws import backup_bucket, get_s3_client
+from services.backup_service import BACKUP_TABLES, backup_chain, latest_manifest
+from services.executors import get_thread_pool
+from services.metrics import count_rows, stage_timer, timed
+from services.restore_service import iter_backup_rows, restore_columns
+
+# Backends the report endpoints can answer from.
+REPORT_BACKENDS = ("database", "analytics")
+
+# Seconds a loaded snapshot is used before checking S3 for a newer backup.
+ANALYTICS_REFRESH_SECONDS = float(os.getenv("ANALYTICS_REFRESH_SECONDS", "60"))
+# Rows converted to Arrow and written to Parquet at a time while building a snapshot.
+SNAPSHOT_BATCH_ROWS = int(os.getenv("SNAPSHOT_BATCH_ROWS", "100000"))
+SNAPSHOT_COMPRESSION = os.getenv("SNAPSHOT_COMPRESSION", "zstd")
+
+# Columns the reports read; only these are loaded into memory.
+REPORT_COLUMNS = {
+    "departments": ["id", "department"],
+    "jobs": ["id", "job"],
+    "hired_employees": ["department_id", "job_id", "hired_at"],
+}
+
+AVRO_TO_ARROW = {"int": "int64", "long": "int64", "string": "string"}
+
+
+class AnalyticsSnapshot:
+    """Arrow tables holding the report columns of one backup."""
+
+    def __init__(self, backup_id: str, tables: dict):
+        self.backup_id = backup_id
+        self.tables = tables
+        self.checked_at = time.monotonic()
+
+
+# pyarrow is optional and slow to import, so it is only loaded by the first
+# analytics request (see require_pyarrow).
+pa = pc = pq = None
+
+_snapshot = None
+_snapshot_lock = threading.Lock()
+# Snapshot build running in the I/O thread pool, if any.
+_build = None
+_build_lock = threading.Lock()
+
+def require_pyarrow():
+    """Imports pyarrow on first use; raises RuntimeError if it is not installed."""
+    global pa, pc, pq
+    if pa is None:
+        try:
+            import pyarrow
+            import pyarrow.compute
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError("The analytics backend requires the pyarrow package")
+        pc, pq = pyarrow.compute, pyarrow.parquet
+        pa = pyarrow
+
+def snapshot_key(backup_id: str, table_name: str):
+    return f"analytics/{backup_id}/{table_name}.parquet"
+
+def arrow_schema(table_name: str):
+    """
+    Parquet schema of a snapshot table, in the order iter_backup_rows yields
+    columns: the Avro backup fields plus the typed hired_at.
+    """
+    _, avro_schema = BACKUP_TABLES[table_name]
+    types = {f["name"]: getattr(pa, AVRO_TO_ARROW[f["type"]])() for f in avro_schema["fields"]}
+    types["hired_at"] = pa.timestamp("us")
+    return pa.schema([pa.field(column, types[column]) for column in restore_columns(table_name)])
+
+def write_snapshot_table(path: str, table_name: str, chain):
+    """
+    Writes the rows of every backup part of table_name in chain to a Parquet
+    file, a batch at a time. Returns the number of rows written.
+    """
+    schema = arrow_schema(table_name)
+    written = 0
+    with pq.ParquetWriter(path, schema, compression=SNAPSHOT_COMPRESSION) as writer:
+        batch = []
+
+        def flush():
+            writer.write_batch(pa.RecordBatch.from_arrays(
+                [pa.array(values, type=field.type) for values, field in zip(zip(*batch), schema)],
+                schema=schema,
+            ))
+            batch.clear()
+
+        for manifest in chain:
+            for part in manifest["tables"].get(table_name, {}).get("parts", []):
+                for row in iter_backup_rows(table_name, part):
+                    batch.append(row)
+                    if len(batch) >= SNAPSHOT_BATCH_ROWS:
+                        written += len(batch)
+                        flush()
+        if batch:
+            written += len(batch)
+            flush()
+    return written
+
+def build_snapshot(chain=None):
+    """
+    Converts the latest backup (full backup plus its incrementals) into one
+    Parquet file per table under analytics/<backup id>/ in the backup bucket,
+    and makes it the snapshot reports are answered from.
+    Returns the backup id and the rows written per table.
+    """
+    global _snapshot
+    require_pyarrow()
+    chain = chain or backup_chain()
+    backup_id = chain[-1]["backup_id"]
+    rows = {}
+    tables = {}
+    with tempfile.TemporaryDirectory(prefix="analytics-") as work_dir:
+        for table_name in BACKUP_TABLES:
+            path = os.path.join(work_dir, f"{table_name}.parquet")
+            with stage_timer("analytics", "build", table=table_name):
+                rows[table_name] = write_snapshot_table(path, table_name, chain)
+            with stage_timer("analytics", "upload", table=table_name):
+                get_s3_client().upload_file(path, backup_bucket(), snapshot_key(backup_id, table_name))
+            tables[table_name] = pq.read_table(path, columns=REPORT_COLUMNS[table_name])
+            count_rows("analytics", rows[table_name], table=table_name)
+    _snapshot = AnalyticsSnapshot(backup_id, tables)
+    print(f"Built analytics snapshot {backup_id}: {rows}")
+    return {"backup_id": backup_id, "rows": rows}
+
+def load_snapshot(backup_id: str):
+    """Reads the report columns of a stored snapshot, or returns None if it was never built."""
+    client = get_s3_client()
+    tables = {}
+    for table_name in BACKUP_TABLES:
+        with tempfile.TemporaryFile() as data, stage_timer("analytics", "load", table=table_name):
+            try:
+                client.download_fileobj(backup_bucket(), snapshot_key(backup_id, table_name), data)
+            except client.exceptions.ClientError as e:
+                if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey"):
+                    return None
+                raise
+            data.seek(0)
+            tables[table_name] = pq.read_table(data, columns=REPORT_COLUMNS[table_name])
+    return AnalyticsSnapshot(backup_id, tables)
+
+def _build_latest():
+    try:
+        return build_snapshot()
+    except Exception as e:
+        print(f"Analytics snapshot build failed: {e}")
+        raise
+
+def start_snapshot_build():
+    """
+    Builds the snapshot of the latest backup in the I/O thread pool, unless a
+    build is already running. Returns the build's future.
+    """
+    global _build
+    with _build_lock:
+        if _build is None or _build.done():
+            _build = get_thread_pool().submit(_build_latest)
+        return _build
+
+def current_snapshot():
+    """
+    Returns the snapshot reports are answered from. The loaded snapshot is
+    reused for ANALYTICS_REFRESH_SECONDS; after that the latest manifest is
+    checked and a newer backup's snapshot is loaded from S3. A backup without
+    a snapshot yet is never converted inside a request: a background build
+    is started and the previous snapshot keeps answering until it is done
+    (RuntimeError if there is none).
+    """
+    global _snapshot
+    require_pyarrow()
+    snapshot = _snapshot
+    if snapshot is not None and time.monotonic() - snapshot.checked_at < ANALYTICS_REFRESH_SECONDS:
+        return snapshot
+    with _snapshot_lock:
+        snapshot = _snapshot
+        if snapshot is not None and time.monotonic() - snapshot.checked_at < ANALYTICS_REFRESH_SECONDS:
+            return snapshot
+        manifest = latest_manifest()
+        if manifest is None:
+            raise RuntimeError("No backup found to build an analytics snapshot from")
+        if snapshot is not None and snapshot.backup_id == manifest["backup_id"]:
+            snapshot.checked_at = time.monotonic()
+            return snapshot
+        loaded = load_snapshot(manifest["backup_id"])
+        if loaded is None:
+            start_snapshot_build()
+            if snapshot is None:
+                raise RuntimeError(f"The snapshot of backup {manifest['backup_id']} is being built; try again shortly")
+            snapshot.checked_at = time.monotonic()
+            return snapshot
+        _snapshot = loaded
+        return loaded
+
+def invalidate_snapshot():
+    """Makes the next report check for a newer backup instead of waiting for the refresh interval."""
+    snapshot = _snapshot
+    if snapshot is not None:
+        snapshot.checked_at = float("-inf")
+
+def _fold(value: str):
+    return "".join(c for c in unicodedata.normalize("NFKD", value) if not unicodedata.combining(c)).casefold()
+
+def _identity(value: str):
+    return value
+
+def collation_key():
+    """
+    Returns a sort key that orders names like the database the SQL reports
+    run on: MySQL's default utf8mb4 collation ignores case and accents,
+    SQLite compares code points.
+    """
+    return _fold if engine.dialect.name == "mysql" else _identity
+
+def _hires_in_year(snapshot: AnalyticsSnapshot, year: int):
+    hires = snapshot.tables["hired_employees"]
+    # Rows without a hire datetime have a null year and are filtered out.
+    return hires.filter(pc.equal(pc.year(hires["hired_at"]), year))
+
+@timed("report", "analytics_query", report="employees_hired_per_quarter")
+def hired_employees_per_quarter(snapshot: AnalyticsSnapshot, year: int = 2021, after=None):
+    """
+    Columnar version of query1.fetch_hired_employees_per_quarter: hires in
+    the given year per quarter, by department and job, sorted alphabetically.
+    after skips the rows up to and including that (department, job) pair.
+    """
+    hires = _hires_in_year(snapshot, year)
+    quarter = pc.quarter(hires["hired_at"])
+    quarters = [f"Q{q}" for q in range(1, 5)]
+    counts = pa.table(
+        [hires["department_id"], hires["job_id"]] + [pc.cast(pc.equal(quarter, q), pa.int64()) for q in range(1, 5)],
+        names=["department_id", "job_id"] + quarters,
+    ).group_by(["department_id", "job_id"]).aggregate([(q, "sum") for q in quarters])
+    # Inner joins, as in the SQL report: hires whose department or job is
+    # missing (loaded before reference checks, or restored) are left out.
+    named = (
+        counts.join(snapshot.tables["departments"], "department_id", "id", join_type="inner")
+        .join(snapshot.tables["jobs"], "job_id", "id", join_type="inner")
+        .group_by(["department", "job"])
+        .aggregate([(f"{q}_sum", "sum") for q in quarters])
+    )
+    items = [
+        {"department": row["department"], "job": row["job"], **{q: int(row[f"{q}_sum_sum"]) for q in quarters}}
+        for row in named.to_pylist()
+    ]
+    # One row per department/job pair, so sorting in Python is cheap; it lets
+    # ordering and cursors use the database's collation.
+    key = collation_key()
+    items.sort(key=lambda item: (key(item["department"]), key(item["job"])))
+    if after is not None:
+        after_key = (key(after[0]), key(after[1]))
+        items = [item for item in items if (key(item["department"]), key(item["job"])) > after_key]
+    return items
+
+@timed("report", "analytics_query", report="departments_above_mean_hires")
+def departments_above_mean_hires(snapshot: AnalyticsSnapshot, year: int = 2021):
+    """
+    Columnar version of query2.fetch_departments_above_mean_hires: departments
+    that hired more than the mean in the given year, most hires first.
+    """
+    hires = _hires_in_year(snapshot, year)
+    totals = (
+        pa.table([hires["department_id"]], names=["department_id"])
+        .group_by("department_id")
+        .aggregate([("department_id", "count")])
+        .join(snapshot.tables["departments"], "department_id", "id", join_type="inner")
+    )
+    if totals.num_rows == 0:
+        return []
+    counts = totals["department_id_count"]
+    above = totals.filter(pc.greater(counts, pc.mean(counts)))
+    above = above.sort_by([("department_id_count", "descending"), ("department_id", "ascending")])
+    return [
+        {"department_id": row["department_id"], "department_name": row["department"], "total_hires": row["department_id_count"]}
+        for row in above.to_pylist()
+    ]
+
+async def iter_rows(items):
+    """Yields report rows as the async iterator streaming_report expects."""
+    for item in items:
+        yield item
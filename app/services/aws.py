@@ -0,0 +1,42 @@
+# services/aws.py
+import os
+import threading
+
+# Buckets for raw uploads (and their error files) and for Avro backups. They
+# are checked when first needed, so the API starts without them.
+S3_BUCKET = os.getenv("S3_BUCKET")
+S3_BACKUP_BUCKET = os.getenv("S3_BACKUP_BUCKET")
+# Connections kept open by the shared S3 client.
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", "20"))
+
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
+def get_s3_client():
+    """
+    Returns the S3 client shared by the whole process, creating it on first
+    use. boto3 is only imported here: loading it and building a client is
+    the slowest part of startup. boto3 clients are thread-safe and keep a
+    pool of connections, so reusing one avoids a new client and TLS
+    handshake per request.
+    """
+    global _s3_client
+    if _s3_client is None:
+        with _s3_client_lock:
+            if _s3_client is None:
+                import boto3
+                from botocore.config import Config
+                _s3_client = boto3.client("s3", config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS))
+    return _s3_client
+
+def raw_data_bucket():
+    """Returns the raw data bucket, or raises RuntimeError if S3_BUCKET is not set."""
+    if not S3_BUCKET:
+        raise RuntimeError("S3_BUCKET environment variable is not set.")
+    return S3_BUCKET
+
+def backup_bucket():
+    """Returns the backup bucket, or raises RuntimeError if S3_BACKUP_BUCKET is not set."""
+    if not S3_BACKUP_BUCKET:
+        raise RuntimeError("S3_BACKUP_BUCKET environment variable is not set.")
+    return S3_BACKUP_BUCKET
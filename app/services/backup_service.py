@@ -1,16 +1,44 @@
 # services/backup_service.py
+import hashlib
+import io
+import json
+import math
 import os
-import boto3
-from fastavro import writer, parse_schema
-from db import SessionLocal
+import queue
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from fastavro import parse_schema
+from fastavro.write import Writer
+from sqlalchemy import func, select
+from db import engine
 from models import HiredEmployee, Department, Job
+from services.aws import backup_bucket, get_s3_client
+from services.metrics import count_bytes, count_rows, record_throughput, stage_timer
+from services.table_rewrites import rewrite_counts
 
-# AWS S3 Configuration
-S3_BUCKET = os.getenv("S3_BACKUP_BUCKET")
-if not S3_BUCKET:
-    raise RuntimeError("S3_BACKUP_BUCKET environment variable is not set.")
+# Avro encoding: codec (null, deflate, snappy or zstd) and target block size in bytes.
+# snappy needs the cramjam package; zstd needs the zstd library fastavro looks for
+# (zstandard, or backports.zstd in recent versions). check_backup_codec verifies both.
+BACKUP_CODEC = os.getenv("BACKUP_CODEC", "deflate")
+BACKUP_BLOCK_SIZE = int(os.getenv("BACKUP_BLOCK_SIZE", str(1024 * 1024)))
+SUPPORTED_CODECS = ("null", "deflate", "snappy", "zstd")
+AVRO_CODECS = {"zstd": "zstandard"}
 
-s3_client = boto3.client("s3")
+# Rows fetched per round trip from the server-side cursor.
+BACKUP_FETCH_SIZE = int(os.getenv("BACKUP_FETCH_SIZE", "10000"))
+
+# Multipart upload part size; S3 requires at least 5 MiB for all but the last part.
+MIN_S3_PART_SIZE = 5 * 1024 * 1024
+S3_PART_SIZE = int(os.getenv("S3_PART_SIZE", str(8 * 1024 * 1024)))
+
+# Parallel backups: worker connections, and rows per part file for large tables.
+BACKUP_WORKERS = int(os.getenv("BACKUP_WORKERS", "4"))
+BACKUP_PART_ROWS = int(os.getenv("BACKUP_PART_ROWS", "1000000"))
+
+LATEST_MANIFEST_KEY = "backups/latest.json"
 
 # Define Avro schemas
 HIRED_EMPLOYEES_SCHEMA = {
@@ -46,55 +74,355 @@ JOBS_SCHEMA = {
     ]
 }
 
-def upload_to_s3(file_path: str, s3_key: str):
+BACKUP_TABLES = {
+    "hired_employees": (HiredEmployee, HIRED_EMPLOYEES_SCHEMA),
+    "departments": (Department, DEPARTMENTS_SCHEMA),
+    "jobs": (Job, JOBS_SCHEMA),
+}
+
+class S3MultipartWriter:
     """
-    Uploads a file to the specified S3 bucket.
-    Returns the S3 URL of the uploaded file.
+    Write-only file object that streams its bytes to S3 with a multipart upload.
+    Only one part is buffered in memory at a time; objects smaller than one
+    part are sent with a single put_object. A SHA-256 checksum and byte count
+    of everything written are kept.
     """
+
+    def __init__(self, bucket: str, key: str, part_size: int = S3_PART_SIZE):
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, MIN_S3_PART_SIZE)
+        self.bytes_written = 0
+        self._sha256 = hashlib.sha256()
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+
+    def write(self, data):
+        self._buffer += data
+        self._sha256.update(data)
+        self.bytes_written += len(data)
+        if len(self._buffer) >= self.part_size:
+            self._upload_part()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    @property
+    def checksum(self):
+        return self._sha256.hexdigest()
+
+    def _upload_part(self):
+        if self._upload_id is None:
+            self._upload_id = get_s3_client().create_multipart_upload(Bucket=self.bucket, Key=self.key)["UploadId"]
+        part_number = len(self._parts) + 1
+        response = get_s3_client().upload_part(
+            Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+            PartNumber=part_number, Body=bytes(self._buffer),
+        )
+        self._parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+        self._buffer = bytearray()
+
+    def close(self):
+        """Uploads the remaining bytes and completes the upload."""
+        if self._upload_id is None:
+            get_s3_client().put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer))
+            self._buffer = bytearray()
+            return
+        if self._buffer:
+            self._upload_part()
+        get_s3_client().complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+            MultipartUpload={"Parts": self._parts},
+        )
+
+    def abort(self):
+        """Discards any parts already uploaded."""
+        if self._upload_id is not None:
+            get_s3_client().abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+def s3_url(s3_key: str):
+    return f"https://{backup_bucket()}.s3.amazonaws.com/{s3_key}"
+
+def write_avro_stream(out, schema: dict, rows, columns):
+    """
+    Encodes rows (tuples in columns order) into out as Avro, one block per
+    BACKUP_BLOCK_SIZE bytes, as they are consumed.
+    Returns the number of rows written.
+    """
+    avro_writer = Writer(out, parse_schema(schema), codec=AVRO_CODECS.get(BACKUP_CODEC, BACKUP_CODEC), sync_interval=BACKUP_BLOCK_SIZE)
+    count = 0
+    for row in rows:
+        avro_writer.write(dict(zip(columns, row)))
+        count += 1
+    avro_writer.flush()
+    return count
+
+def check_backup_codec():
+    """
+    Raises RuntimeError if BACKUP_CODEC is not supported or its compression
+    library is missing, by encoding a one-row file with it; called at startup
+    so a bad setting fails there instead of in the first backup.
+    """
+    if BACKUP_CODEC not in SUPPORTED_CODECS:
+        raise RuntimeError(f"Unsupported BACKUP_CODEC {BACKUP_CODEC}. Expected one of: {', '.join(SUPPORTED_CODECS)}")
     try:
-        s3_client.upload_file(file_path, S3_BUCKET, s3_key)
-        s3_url = f"https://{S3_BUCKET}.s3.amazonaws.com/{s3_key}"
-        return s3_url
+        write_avro_stream(io.BytesIO(), JOBS_SCHEMA, [(1, "job")], ["id", "job"])
     except Exception as e:
-        raise RuntimeError(f"Error uploading to S3: {e}")
+        raise RuntimeError(f"BACKUP_CODEC {BACKUP_CODEC} cannot be used: {e}")
 
-def backup_table_to_avro(table_name: str, model, schema: dict):
+def backup_part(connection, backup_id: str, table_name: str, part: int, start_id=None, end_id=None):
     """
-    Backs up a table into an Avro file and uploads it to AWS S3.
-    Returns the S3 URL of the backup file.
+    Backs up the rows of table_name with start_id <= id < end_id (the whole
+    table if no range is given) into one Avro part file in S3.
+    Rows are read from a server-side cursor in BACKUP_FETCH_SIZE chunks and
+    encoded and uploaded as they arrive, so neither the rows nor the file are
+    ever held in memory or written to local disk.
+    Returns the part's manifest entry.
     """
-    avro_file_path = f"/tmp/{table_name}_backup.avro"
-    s3_key = f"backups/{table_name}_backup.avro"
+    model, schema = BACKUP_TABLES[table_name]
+    s3_key = f"backups/{backup_id}/{table_name}/part-{part:05d}.avro"
+    columns = [field["name"] for field in schema["fields"]]
+    table = model.__table__
+    query = select(*[table.c[name] for name in columns]).order_by(table.c.id)
+    if start_id is not None:
+        query = query.where(table.c.id >= start_id, table.c.id < end_id)
+
+    try:
+        with stage_timer("backup", "export_part", table=table_name):
+            with S3MultipartWriter(backup_bucket(), s3_key) as out:
+                result = connection.execution_options(stream_results=True, yield_per=BACKUP_FETCH_SIZE).execute(query)
+                rows = write_avro_stream(out, schema, result, columns)
+    except Exception as e:
+        raise RuntimeError(f"Error backing up {table_name} part {part} to S3: {e}")
+    count_rows("backup", rows, table=table_name)
+    count_bytes("backup", out.bytes_written, table=table_name)
+
+    return {
+        "table": table_name,
+        "part": part,
+        "key": s3_key,
+        "url": s3_url(s3_key),
+        "start_id": start_id,
+        "end_id": end_id,
+        "rows": rows,
+        "bytes": out.bytes_written,
+        "sha256": out.checksum,
+    }
 
-    # Query all records from the database
-    db = SessionLocal()
+@contextmanager
+def snapshot_connections(count: int, tables):
+    """
+    Opens count connections that all read the same point in time.
+    On MySQL the tables are briefly locked for reads while every connection
+    starts a consistent-snapshot transaction, so no write can land between
+    them. Other databases get plain connections.
+    """
+    connections = []
     try:
-        records = db.query(model).all()
+        if engine.dialect.name == "mysql":
+            with engine.connect() as coordinator:
+                coordinator.exec_driver_sql("LOCK TABLES " + ", ".join(f"`{t}` READ" for t in tables))
+                try:
+                    for _ in range(count):
+                        connection = engine.connect()
+                        connections.append(connection)
+                        connection.exec_driver_sql("START TRANSACTION WITH CONSISTENT SNAPSHOT, READ ONLY")
+                finally:
+                    coordinator.exec_driver_sql("UNLOCK TABLES")
+        else:
+            connections = [engine.connect() for _ in range(count)]
+        yield connections
     finally:
-        db.close()
+        for connection in connections:
+            connection.close()
+
+def plan_parts(connection, tables, part_rows: int = None, after_ids: dict = None):
+    """
+    Splits each table into primary-key ranges of about part_rows rows.
+    after_ids maps tables to a watermark: only rows with a greater id are
+    included. Returns (plan, watermarks), where plan holds
+    (table_name, part, start_id, end_id) tuples and watermarks the highest id
+    covered per table.
+    """
+    part_rows = part_rows or BACKUP_PART_ROWS
+    after_ids = after_ids or {}
+    plan = []
+    watermarks = {}
+    for table_name in tables:
+        model, _ = BACKUP_TABLES[table_name]
+        id_column = model.__table__.c.id
+        query = select(func.min(id_column), func.max(id_column), func.count()).select_from(model.__table__)
+        after_id = after_ids.get(table_name)
+        if after_id is not None:
+            query = query.where(id_column > after_id)
+        min_id, max_id, count = connection.execute(query).one()
+        watermarks[table_name] = max_id if count else after_id
+        if not count:
+            continue
+        num_parts = math.ceil(count / part_rows)
+        step = math.ceil((max_id - min_id + 1) / num_parts)
+        for part in range(num_parts):
+            start_id = min_id + part * step
+            plan.append((table_name, part, start_id, min(start_id + step, max_id + 1)))
+    return plan, watermarks
+
+def write_manifest(manifest: dict):
+    """
+    Stores the manifest next to its parts and as the latest backup.
+    Raises RuntimeError rather than overwrite the manifest of an existing backup.
+    """
+    body = json.dumps(manifest, indent=2).encode()
+    key = manifest_key(manifest["backup_id"])
+    client = get_s3_client()
+    try:
+        client.head_object(Bucket=backup_bucket(), Key=key)
+    except client.exceptions.ClientError as e:
+        if e.response.get("Error", {}).get("Code") not in ("404", "NoSuchKey"):
+            raise
+    else:
+        raise RuntimeError(f"Backup manifest {key} already exists")
+    client.put_object(Bucket=backup_bucket(), Key=key, Body=body)
+    client.put_object(Bucket=backup_bucket(), Key=LATEST_MANIFEST_KEY, Body=body)
 
-    # Convert SQLAlchemy objects to dictionaries
-    records_dict = []
-    for record in records:
-        rec = record.__dict__
-        rec.pop("_sa_instance_state", None)
-        records_dict.append(rec)
+def load_manifest(key: str = LATEST_MANIFEST_KEY):
+    """Reads a backup manifest from S3."""
+    try:
+        return json.loads(get_s3_client().get_object(Bucket=backup_bucket(), Key=key)["Body"].read())
+    except Exception as e:
+        raise RuntimeError(f"Error reading backup manifest {key}: {e}")
 
-    # Write to Avro file
-    parsed_schema = parse_schema(schema)
-    with open(avro_file_path, "wb") as out_file:
-        writer(out_file, parsed_schema, records_dict)
+def latest_manifest():
+    """Returns the most recent backup manifest, or None if there is no usable one."""
+    try:
+        return load_manifest()
+    except RuntimeError:
+        return None
+
+def manifest_key(backup_id: str):
+    return f"backups/{backup_id}/manifest.json"
 
-    # Upload to S3 and return the S3 URL
-    return upload_to_s3(avro_file_path, s3_key)
+def new_backup_id(snapshot_at: datetime):
+    """Timestamp to the microsecond plus a random suffix, unique even for backups taken at the same moment."""
+    return f"{snapshot_at.strftime('%Y%m%dT%H%M%S%fZ')}-{uuid.uuid4().hex[:8]}"
 
-def backup_all_tables():
+def parent_manifest(manifest: dict, seen: set):
+    """
+    Loads the parent of manifest. Raises RuntimeError if it has none or the
+    chain loops back to a backup already in seen.
+    """
+    parent = manifest.get("parent")
+    if not parent:
+        raise RuntimeError(f"Backup {manifest['backup_id']} has no parent backup")
+    if parent in seen:
+        raise RuntimeError(f"Backup chain loops back to {parent}")
+    seen.add(parent)
+    return load_manifest(manifest_key(parent))
+
+def backup_chain(point_in_time: datetime = None):
+    """
+    Returns the manifests to replay to restore the data as of point_in_time
+    (the latest backup if None): the most recent full backup taken at or
+    before that time followed by its incremental backups, oldest first.
+    """
+    if point_in_time is not None and point_in_time.tzinfo is None:
+        point_in_time = point_in_time.replace(tzinfo=timezone.utc)
+
+    manifest = load_manifest()
+    seen = {manifest["backup_id"]}
+    while point_in_time is not None and datetime.fromisoformat(manifest["created_at"]) > point_in_time:
+        if not manifest.get("parent"):
+            raise RuntimeError(f"No backup exists at or before {point_in_time.isoformat()}")
+        manifest = parent_manifest(manifest, seen)
+
+    chain = [manifest]
+    while manifest["type"] != "full":
+        manifest = parent_manifest(manifest, seen)
+        chain.append(manifest)
+    return list(reversed(chain))
+
+def backup_all_tables(tables=None, incremental: bool = False):
     """
     Creates Avro backups for all tables and uploads them to AWS S3.
-    Returns a dictionary with table names and their S3 URLs.
+    Every table is read from the same consistent snapshot, large tables are
+    split by primary-key range, and parts are written in parallel by up to
+    BACKUP_WORKERS workers, each on its own snapshot connection.
+
+    With incremental=True only rows above each table's watermark (the highest
+    id in the previous backup) are exported, as a delta chained to that
+    backup. Rows changed below the watermark (upserts overwriting rows,
+    replace ingests, restores) are counted by record_rewrite; if any count
+    moved since the previous backup, or there is no previous backup, a full
+    backup is taken instead.
+    Returns the backup manifest listing every part with its row count and checksum.
     """
-    backup_files = {}
-    backup_files["hired_employees"] = backup_table_to_avro("hired_employees", HiredEmployee, HIRED_EMPLOYEES_SCHEMA)
-    backup_files["departments"] = backup_table_to_avro("departments", Department, DEPARTMENTS_SCHEMA)
-    backup_files["jobs"] = backup_table_to_avro("jobs", Job, JOBS_SCHEMA)
-    return backup_files
+    tables = list(tables or BACKUP_TABLES)
+    snapshot_at = datetime.now(timezone.utc)
+    backup_id = new_backup_id(snapshot_at)
+
+    previous = latest_manifest()
+    after_ids = None
+    if incremental and previous is not None:
+        after_ids = {t: previous["tables"].get(t, {}).get("watermark") for t in tables}
+    else:
+        incremental = False
+
+    started = time.perf_counter()
+    with snapshot_connections(BACKUP_WORKERS, tables) as connections:
+        rewrites = rewrite_counts(connections[0], tables)
+        if incremental and {t: previous.get("rewrites", {}).get(t) for t in tables} != rewrites:
+            print(f"Rows changed below the watermark since backup {previous['backup_id']}; taking a full backup")
+            incremental = False
+            after_ids = None
+        with stage_timer("backup", "plan"):
+            plan, watermarks = plan_parts(connections[0], tables, after_ids=after_ids)
+        available = queue.Queue()
+        for connection in connections:
+            available.put(connection)
+
+        def run(part_plan):
+            connection = available.get()
+            try:
+                return backup_part(connection, backup_id, *part_plan)
+            finally:
+                available.put(connection)
+
+        with ThreadPoolExecutor(max_workers=len(connections)) as pool:
+            parts = list(pool.map(run, plan))
+
+    manifest = {
+        "backup_id": backup_id,
+        "type": "incremental" if incremental else "full",
+        "parent": previous["backup_id"] if previous else None,
+        "created_at": snapshot_at.isoformat(),
+        "codec": BACKUP_CODEC,
+        "rewrites": rewrites,
+        "tables": {
+            table_name: {
+                "rows": sum(p["rows"] for p in parts if p["table"] == table_name),
+                "watermark": watermarks[table_name],
+                "parts": [p for p in parts if p["table"] == table_name],
+            }
+            for table_name in tables
+        },
+    }
+    with stage_timer("backup", "manifest"):
+        write_manifest(manifest)
+    record_throughput("backup", sum(p["rows"] for p in parts), time.perf_counter() - started)
+    return manifest
@@ -0,0 +1,89 @@
+# services/bulk_insert.py
+import csv
+import os
+import tempfile
+
+from db import LOCAL_INFILE
+
+# Rows sent per executemany call.
+INSERT_BATCH_SIZE = int(os.getenv("INSERT_BATCH_SIZE", "1000"))
+
+# "executemany" (default) or "load_data" (MySQL LOAD DATA LOCAL INFILE).
+INSERT_METHOD = os.getenv("INSERT_METHOD", "executemany")
+
+def _placeholder(connection):
+    return "?" if connection.dialect.paramstyle in ("qmark", "numeric") else "%s"
+
+def _quoted(connection, name: str):
+    return connection.dialect.identifier_preparer.quote(name)
+
+def insert_sql(connection, table_name: str, columns):
+    """Builds a plain "INSERT INTO table (columns) VALUES (...)" statement."""
+    placeholders = ", ".join([_placeholder(connection)] * len(columns))
+    column_list = ", ".join(_quoted(connection, c) for c in columns)
+    return f"INSERT INTO {_quoted(connection, table_name)} ({column_list}) VALUES ({placeholders})"
+
+def upsert_sql(connection, table_name: str, columns, key: str = "id"):
+    """
+    Builds an INSERT that updates the non-key columns of rows whose key already
+    exists: ON DUPLICATE KEY UPDATE on MySQL, ON CONFLICT elsewhere.
+    """
+    updates = [_quoted(connection, c) for c in columns if c != key]
+    if connection.dialect.name == "mysql":
+        assignments = ", ".join(f"{c} = VALUES({c})" for c in updates)
+        return f"{insert_sql(connection, table_name, columns)} ON DUPLICATE KEY UPDATE {assignments}"
+    assignments = ", ".join(f"{c} = excluded.{c}" for c in updates)
+    return f"{insert_sql(connection, table_name, columns)} ON CONFLICT ({_quoted(connection, key)}) DO UPDATE SET {assignments}"
+
+def executemany_insert(connection, table_name: str, columns, rows, batch_size: int = INSERT_BATCH_SIZE, upsert: bool = False):
+    """
+    Inserts plain tuples through the DB-API executemany, batch_size rows per call.
+    PyMySQL rewrites each call into multi-row INSERT statements.
+    """
+    sql = upsert_sql(connection, table_name, columns) if upsert else insert_sql(connection, table_name, columns)
+    for start in range(0, len(rows), batch_size):
+        connection.exec_driver_sql(sql, rows[start:start + batch_size])
+
+def load_data_insert(connection, table_name: str, columns, rows, upsert: bool = False):
+    """
+    Loads rows with MySQL LOAD DATA LOCAL INFILE from a temporary CSV file.
+    Requires DB_LOCAL_INFILE=true so the driver allows local files.
+    With upsert=True existing keys are replaced (LOAD DATA ... REPLACE).
+
+    A LOCAL load always behaves as if IGNORE were given: rows with a
+    duplicate key are skipped with only a warning. Without upsert the
+    affected-row count is therefore checked, and a load that skipped rows
+    raises RuntimeError (with MySQL's first warnings), so the caller's
+    transaction rolls back as it would on a duplicate key with executemany.
+    """
+    column_list = ", ".join(_quoted(connection, c) for c in columns)
+    with tempfile.NamedTemporaryFile(mode="w", newline="", suffix=".csv") as temp_file:
+        csv.writer(temp_file, lineterminator="\n").writerows(rows)
+        temp_file.flush()
+        result = connection.exec_driver_sql(
+            f"LOAD DATA LOCAL INFILE '{temp_file.name}' {'REPLACE ' if upsert else ''}INTO TABLE {_quoted(connection, table_name)} "
+            "CHARACTER SET utf8mb4 "
+            "FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '\"' ESCAPED BY '' "
+            f"LINES TERMINATED BY '\\n' ({column_list})"
+        )
+    if not upsert and result.rowcount != len(rows):
+        warnings = connection.exec_driver_sql("SHOW WARNINGS LIMIT 3").fetchall()
+        details = "; ".join(str(w[2]) for w in warnings)
+        raise RuntimeError(
+            f"LOAD DATA loaded {result.rowcount} of {len(rows)} rows into {table_name}"
+            + (f": {details}" if details else "")
+        )
+
+def bulk_insert(connection, table_name: str, columns, rows, method: str = None, batch_size: int = None, upsert: bool = False):
+    """
+    Inserts rows (a list of tuples in column order) on the given connection.
+    LOAD DATA is only used on MySQL with local infile enabled; otherwise the
+    executemany path is used.
+    """
+    if not rows:
+        return
+    method = method or INSERT_METHOD
+    if method == "load_data" and LOCAL_INFILE and connection.dialect.name == "mysql":
+        load_data_insert(connection, table_name, columns, rows, upsert=upsert)
+    else:
+        executemany_insert(connection, table_name, columns, rows, batch_size or INSERT_BATCH_SIZE, upsert=upsert)
@@ -0,0 +1,123 @@
+# services/compressed_upload.py
+import asyncio
+import gzip
+import os
+import shutil
+import tempfile
+import zipfile
+import zlib
+
+from fastapi import HTTPException
+
+from services.executors import get_thread_pool
+
+try:
+    import zstandard
+except ImportError:  # zstd uploads are rejected without it
+    zstandard = None
+
+# Compressed single-file uploads: suffix -> codec.
+COMPRESSED_SUFFIXES = {".gz": "gzip", ".zst": "zstd"}
+ZIP_SUFFIX = ".zip"
+
+# Zip members are loaded in this order so lookups exist before the rows that reference them.
+MEMBER_ORDER = ("departments.csv", "jobs.csv", "hired_employees.csv")
+
+# Zip archives that are not seekable (S3 streams) are spooled to disk past this size.
+ZIP_SPOOL_MEMORY_BYTES = 16 * 1024 * 1024
+
+# Errors raised by a truncated or corrupt compressed stream.
+DECOMPRESSION_ERRORS = (OSError, EOFError, zlib.error, zipfile.BadZipFile) + ((zstandard.ZstdError,) if zstandard else ())
+
+
+class StreamedUpload:
+    """
+    UploadFile stand-in that reads a synchronous (usually decompressing)
+    stream from the I/O thread pool, so process_csv_file can consume it
+    chunk by chunk without blocking the event loop.
+    """
+
+    def __init__(self, filename: str, stream):
+        self.filename = filename
+        self._stream = stream
+
+    async def read(self, size: int = -1):
+        try:
+            return await asyncio.get_running_loop().run_in_executor(get_thread_pool(), self._stream.read, size)
+        except DECOMPRESSION_ERRORS as e:
+            raise HTTPException(status_code=400, detail=f"Could not decompress {self.filename}: {e}")
+
+    async def close(self):
+        self._stream.close()
+
+
+def upload_kind(file_name: str):
+    """Returns ("zip", None), (codec, inner file name) or (None, file_name) for an upload's name."""
+    if file_name.endswith(ZIP_SUFFIX):
+        return "zip", None
+    base, suffix = os.path.splitext(file_name)
+    if suffix in COMPRESSED_SUFFIXES:
+        return COMPRESSED_SUFFIXES[suffix], base
+    return None, file_name
+
+
+def _decompressing_stream(codec: str, raw):
+    if codec == "gzip":
+        return gzip.GzipFile(fileobj=raw, mode="rb")
+    if zstandard is None:
+        raise HTTPException(status_code=400, detail="zstd uploads require the zstandard package")
+    return zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True)
+
+
+def _seekable(raw):
+    """Returns raw if it can seek, otherwise a spooled copy of it."""
+    if getattr(raw, "seekable", lambda: False)():
+        return raw
+    spool = tempfile.SpooledTemporaryFile(max_size=ZIP_SPOOL_MEMORY_BYTES)
+    shutil.copyfileobj(raw, spool, 1024 * 1024)
+    spool.seek(0)
+    return spool
+
+
+def zip_members(raw, known_files):
+    """
+    Opens a zip archive and returns its CSV members in MEMBER_ORDER as
+    (file name, ZipInfo) pairs. Directories are skipped; any other entry
+    whose file name is not in known_files is rejected.
+    """
+    try:
+        archive = zipfile.ZipFile(_seekable(raw))
+    except zipfile.BadZipFile as e:
+        raise HTTPException(status_code=400, detail=f"Invalid zip archive: {e}")
+    members = {}
+    for entry in archive.infolist():
+        if entry.is_dir():
+            continue
+        file_name = os.path.basename(entry.filename)
+        if file_name not in known_files:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Invalid file name in archive: {entry.filename}. Expected one of: " + ", ".join(known_files)
+            )
+        if file_name in members:
+            raise HTTPException(status_code=400, detail=f"Duplicate file in archive: {file_name}")
+        members[file_name] = entry
+    order = {name: i for i, name in enumerate(MEMBER_ORDER)}
+    names = sorted(members, key=lambda name: order.get(name, len(order)))
+    return archive, [(name, members[name]) for name in names]
+
+
+def open_upload_members(file_name: str, raw, known_files):
+    """
+    Splits an upload into the CSV files it holds, as StreamedUpload objects
+    in the order they should be loaded. Plain CSVs are returned as is (None),
+    gzip/zstd files as a single decompressing stream and zip archives as one
+    stream per member. Nothing is decompressed ahead of the reader.
+    """
+    kind, inner_name = upload_kind(file_name)
+    if kind is None:
+        return None
+    if kind == "zip":
+        archive, members = zip_members(raw, known_files)
+        return [StreamedUpload(name, archive.open(entry)) for name, entry in members]
+    return [StreamedUpload(inner_name, _decompressing_stream(kind, raw))]
@@ -1,20 +1,36 @@
 # services/csv_processor.py
+import asyncio
+import collections
 import csv
 import os
-import tempfile
-from datetime import datetime
+import time
+from typing import Optional
 from fastapi import HTTPException, UploadFile
-import boto3
 
-from db import SessionLocal
+from db import engine
 from models import HiredEmployee, Department, Job
+from services.bulk_insert import bulk_insert
+from services.report_cache import bump_data_version
+from services.hires_summary import apply_hire_counts, rebuild_hires_summary, replaced_hire_counts, summarize_hires
+from services.table_rewrites import has_existing_ids, record_rewrite
+from services.table_utils import create_shadow_table, drop_shadow_table, swap_shadow_table
+from services.aws import raw_data_bucket
+from services.compressed_upload import COMPRESSED_SUFFIXES, ZIP_SUFFIX, open_upload_members, upload_kind
+from services.error_sink import ErrorSink
+from services.executors import get_process_pool, get_thread_pool
+from services.metrics import count_bytes, count_rows, observe_stage, record_throughput, stage_timer
+from services.reference_ids import get_reference_ids, invalidate_reference_ids
+from services.validation import ISO_DATETIME, build_column_specs, error_rows, insert_columns, parse_and_validate
 
 # Mapping of file names to their configuration.
 FILE_CONFIG = {
     "hired_employees.csv": {
          "model": HiredEmployee,
          "fields": ["id", "name", "datetime", "department_id", "job_id"],
-         "num_fields": 5
+         "num_fields": 5,
+         "formats": {"datetime": ISO_DATETIME},
+         "parsed_columns": {"datetime": "hired_at"},
+         "references": {"department_id": "departments", "job_id": "jobs"}
     },
     "departments.csv": {
          "model": Department,
@@ -28,138 +44,388 @@ FILE_CONFIG = {
     }
 }
 
-# S3 configuration: ensure S3_BUCKET is set in your environment variables.
-S3_BUCKET = os.getenv("S3_BUCKET")
-if not S3_BUCKET:
-    raise RuntimeError("S3_BUCKET environment variable is not set.")
+# Column specs used by the batch validator, derived from FILE_CONFIG and the models.
+COLUMN_SPECS = {file_name: build_column_specs(config) for file_name, config in FILE_CONFIG.items()}
 
-def upload_error_file_to_s3(file_path: str, key: str):
-    """Uploads the given error file to the configured S3 bucket."""
-    s3_client = boto3.client('s3')
+# Streaming ingest configuration.
+MAX_ROWS_PER_REQUEST = 1000
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "5000"))
+INGEST_CHUNK_SIZE = int(os.getenv("INGEST_CHUNK_SIZE", str(1024 * 1024)))
+# Longest CSV record accepted; a longer one usually means an unbalanced quote.
+INGEST_MAX_RECORD_BYTES = int(os.getenv("INGEST_MAX_RECORD_BYTES", str(4 * 1024 * 1024)))
+INGEST_MODES = ("insert", "upsert", "replace")
+# Blocks parsed/validated ahead of the insert currently running.
+INGEST_WINDOW = int(os.getenv("INGEST_WINDOW", "4"))
+
+def insert_rows(file_name: str, valid_rows, mode: str = "insert", method: Optional[str] = None, shadow: Optional[str] = None):
+    """
+    Inserts a batch of validated rows in a single transaction.
+    In upsert mode existing ids are updated; in replace mode rows go to the
+    shadow table shadow, which is swapped in once the whole file is loaded.
+    Inserts and upserts into hired_employees also update the hires summary
+    in the same transaction: an upsert first subtracts the counts of the
+    rows it overwrites. Replace rebuilds the summary after the swap.
+    An upsert that overwrites existing rows is recorded with record_rewrite,
+    so the next incremental backup is taken in full.
+    """
+    if not valid_rows:
+        return
+    config = FILE_CONFIG[file_name]
+    table_name = config["model"].__tablename__
+    columns = insert_columns(COLUMN_SPECS[file_name])
+    if mode == "replace":
+        table_name = shadow
+    labels = {"table": config["model"].__tablename__}
     try:
-        s3_client.upload_file(file_path, S3_BUCKET, key)
-    except Exception as e:
-        # In production, use proper logging instead of printing.
-        print(f"Error uploading file to S3: {e}")
+        with engine.connect() as connection, connection.begin() as transaction:
+            summarize = file_name == "hired_employees.csv" and mode != "replace"
+            if summarize:
+                rows = valid_rows
+                replaced = None
+                if mode == "upsert":
+                    # The last row of an id is the one left in the table.
+                    id_index = columns.index("id")
+                    rows = list({row[id_index]: row for row in valid_rows}.values())
+                    with stage_timer("ingest", "summary", **labels):
+                        replaced = replaced_hire_counts(connection, [row[id_index] for row in rows])
+            if mode == "upsert":
+                id_index = columns.index("id")
+                if has_existing_ids(connection, config["model"].__table__, [row[id_index] for row in valid_rows]):
+                    record_rewrite(connection, config["model"].__tablename__)
+            with stage_timer("ingest", "insert", **labels):
+                bulk_insert(connection, table_name, columns, valid_rows, method=method, upsert=mode == "upsert")
+            if summarize:
+                with stage_timer("ingest", "summary", **labels):
+                    counts = summarize_hires(
+                        rows, columns.index("hired_at"), columns.index("department_id"), columns.index("job_id")
+                    )
+                    if replaced:
+                        counts.subtract(replaced)
+                    apply_hire_counts(connection, counts)
+            with stage_timer("ingest", "commit", **labels):
+                transaction.commit()
+    except Exception as db_error:
+        raise HTTPException(status_code=500, detail=f"Database error: {db_error}")
+    invalidate_reference_ids(config["model"].__tablename__)
+    bump_data_version()
 
-async def process_csv_file(file: UploadFile):
+class CsvChunkSplitter:
     """
-    Processes the CSV file upload.
-    Valid rows are inserted into the database.
-    Invalid rows are logged and later uploaded to S3 as an error file.
+    Incrementally splits a byte stream into complete CSV records.
+    Bytes after the last record boundary are held back until the next chunk,
+    so quoted fields spanning several lines are never cut in half.
+
+    Quotes are interpreted the way csv.reader does: a '"' opens a quoted
+    field only at the start of a field, '""' inside one is an escaped quote,
+    and a '"' anywhere else is literal text. The quote state and scan offset
+    carry over between chunks, so every byte is examined once and only the
+    quotes cost Python-level work.
     """
-    file_name = file.filename
-    if file_name not in FILE_CONFIG:
+
+    def __init__(self, encoding: str = "utf-8", max_record_bytes: int = None):
+        self.encoding = encoding
+        self.max_record_bytes = max_record_bytes or INGEST_MAX_RECORD_BYTES
+        self._pending = b""
+        # Offset in _pending up to which the quote state is known.
+        self._scanned = 0
+        self._in_quotes = False
+
+    def _scan(self, data: bytes) -> int:
+        """
+        Advances the quote state over data from the last scanned offset.
+        Returns the offset just after the last newline that ends a record,
+        or 0 if there is none.
+        """
+        boundary = 0
+        pos = self._scanned
+        end = len(data)
+        while pos < end:
+            quote = data.find(b'"', pos)
+            if not self._in_quotes:
+                newline = data.rfind(b"\n", pos, quote if quote >= 0 else end)
+                if newline >= 0:
+                    boundary = newline + 1
+                if quote < 0:
+                    pos = end
+                    break
+                # Only a quote at the start of a field opens a quoted field.
+                if quote == 0 or data[quote - 1] in b",\r\n":
+                    self._in_quotes = True
+                pos = quote + 1
+            else:
+                if quote < 0:
+                    pos = end
+                    break
+                if quote + 1 == end:
+                    # Closing or escaped quote? Decide when the next byte arrives.
+                    pos = quote
+                    break
+                if data[quote + 1] == ord('"'):
+                    pos = quote + 2
+                else:
+                    self._in_quotes = False
+                    pos = quote + 1
+        self._scanned = pos
+        return boundary
+
+    def feed(self, chunk: bytes) -> str:
+        """
+        Adds a chunk and returns the text of every record it completes.
+        Raises a 400 if the unfinished record grows past max_record_bytes.
+        """
+        data = self._pending + chunk
+        cut = self._scan(data)
+        self._pending = data[cut:]
+        self._scanned -= cut
+        if len(self._pending) > self.max_record_bytes:
+            raise HTTPException(
+                status_code=400,
+                detail=f"CSV record longer than {self.max_record_bytes} bytes; check for an unbalanced quote",
+            )
+        return data[:cut].decode(self.encoding)
+
+    def flush(self) -> str:
+        """Returns whatever is left once the stream is exhausted."""
+        data, self._pending = self._pending, b""
+        self._scanned = 0
+        self._in_quotes = False
+        return data.decode(self.encoding)
+
+async def iter_csv_blocks(file: UploadFile, chunk_size: int = INGEST_CHUNK_SIZE, table_name: str = None):
+    """
+    Reads the upload in chunks and yields blocks of complete CSV records,
+    each roughly chunk_size bytes long.
+    """
+    splitter = CsvChunkSplitter()
+    while True:
+        with stage_timer("ingest", "read", table=table_name):
+            chunk = await file.read(chunk_size)
+        count_bytes("ingest", len(chunk), table=table_name)
+        text = splitter.feed(chunk) if chunk else splitter.flush()
+        if text:
+            yield text
+        if not chunk:
+            break
+
+def _record_block_timings(table_name: str, block):
+    row_count, valid_rows, errors, (parse_seconds, validate_seconds) = block
+    observe_stage("ingest", "parse", parse_seconds, table=table_name)
+    observe_stage("ingest", "validate", validate_seconds, table=table_name)
+    return row_count, valid_rows, errors
+
+async def _block_result(future):
+    """Awaits a parse_and_validate call, turning CSV syntax errors into a 400."""
+    try:
+        return await future
+    except csv.Error as e:
+        raise HTTPException(status_code=400, detail=f"Invalid CSV: {e}")
+
+async def iter_validated_blocks(file: UploadFile, file_name: str, window: int = INGEST_WINDOW):
+    """
+    Parses and validates the upload's blocks in the process pool, keeping up to
+    window blocks in flight, and yields their results in file order as
+    (row count, valid rows, error details).
+    Rows referencing lookup tables are checked against the cached id sets,
+    which are read once per upload and shipped to the workers with each block.
+    """
+    loop = asyncio.get_running_loop()
+    pool = get_process_pool()
+    specs = COLUMN_SPECS[file_name]
+    table_name = FILE_CONFIG[file_name]["model"].__tablename__
+    references = FILE_CONFIG[file_name].get("references")
+    if references:
+        references = await loop.run_in_executor(get_thread_pool(), get_reference_ids, references)
+    in_flight = collections.deque()
+    try:
+        async for text in iter_csv_blocks(file, table_name=table_name):
+            # No field can be longer than the record cap, so csv may accept up to that.
+            in_flight.append(loop.run_in_executor(
+                pool, parse_and_validate, specs, text, references, INGEST_MAX_RECORD_BYTES,
+            ))
+            if len(in_flight) >= window:
+                yield _record_block_timings(table_name, await _block_result(in_flight.popleft()))
+        while in_flight:
+            yield _record_block_timings(table_name, await _block_result(in_flight.popleft()))
+    finally:
+        for future in in_flight:
+            future.cancel()
+
+def check_upload(file_name: str, mode: str):
+    """
+    Rejects unknown file names and ingest modes with a 400. A table file may
+    also be gzip/zstd compressed, and zip archives are accepted by suffix;
+    their members are checked when the archive is opened.
+    Fails with a 500 if the bucket for error files is not configured.
+    """
+    kind, table_file = upload_kind(file_name)
+    if kind != "zip" and table_file not in FILE_CONFIG:
         raise HTTPException(
             status_code=400, 
             detail="Invalid file name. Expected one of: " + ", ".join(FILE_CONFIG.keys())
+            + f" (optionally compressed as {', '.join(COMPRESSED_SUFFIXES)}), or a {ZIP_SUFFIX} archive of them"
+        )
+    if mode not in INGEST_MODES:
+        raise HTTPException(
+            status_code=400,
+            detail="Invalid mode. Expected one of: " + ", ".join(INGEST_MODES)
         )
-        
+    try:
+        raw_data_bucket()
+    except RuntimeError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+async def process_csv_file(file: UploadFile, stream: bool = False, batch_size: Optional[int] = None, mode: str = "insert", first_row: int = 1, progress=None):
+    """
+    Processes the CSV file upload.
+    Valid rows are inserted into the database.
+    Invalid rows are collected in a gzip-compressed error file that is
+    uploaded to S3 in the background under a key unique to this upload,
+    errors/<table>/<date>/<request id>.csv.gz, returned as "error_file".
+
+    By default the upload is limited to 1,000 rows and inserted in a single
+    transaction. With stream=True the file is read in chunks, and rows are
+    validated, inserted and committed batch by batch with no size limit.
+
+    mode selects how rows are written: "insert" fails on existing ids,
+    "upsert" updates them, and "replace" loads the file into a shadow table
+    that atomically replaces the live table at the end.
+
+    first_row is the number of the upload's first row in error messages, for
+    uploads that are one batch of a larger file.
+    progress, if given, is called as progress(rows processed, inserted rows,
+    error rows) after every block.
+
+    Parsing and validation run in the process pool and database/S3 calls in
+    the thread pool, so the event loop stays free for other requests.
+    """
+    file_name = file.filename
+    check_upload(file_name, mode)
+
     config = FILE_CONFIG[file_name]
-    model = config["model"]
-    expected_num_fields = config["num_fields"]
+    table_name = config["model"].__tablename__
+    loop = asyncio.get_running_loop()
+    io_pool = get_thread_pool()
+    started = time.perf_counter()
 
-    # Read, decode, and parse the CSV file.
-    contents = await file.read()
-    decoded_lines = contents.decode('utf-8').splitlines()
-    reader = csv.reader(decoded_lines)
-    rows = list(reader)
+    # Without streaming everything is inserted at the end in one transaction.
+    batch_limit = (batch_size or INGEST_BATCH_SIZE) if stream else None
 
-    # Limit to 1,000 rows per request.
-    if len(rows) > 1000:
-        raise HTTPException(
-            status_code=400, 
-            detail="Maximum of 1000 rows allowed per request."
-        )
+    inserted_rows = 0
+    error_count = 0
+    next_row_number = first_row
+    pending_rows = []
+    error_sink = ErrorSink(raw_data_bucket(), table_name, config["fields"] + ["error_message"])
+
+    shadow = None
+    if mode == "replace":
+        shadow = await loop.run_in_executor(io_pool, _run_in_transaction, create_shadow_table, table_name)
 
-    valid_objects = []
-    error_rows = []
-    row_number = 0
-
-    for row in rows:
-        row_number += 1
-
-        # Validate field count.
-        if len(row) != expected_num_fields:
-            error_rows.append(row + [f"Row {row_number}: Expected {expected_num_fields} fields, got {len(row)}"])
-            continue
-
-        # Trim whitespace and ensure no empty fields.
-        row = [field.strip() for field in row]
-        if any(field == "" for field in row):
-            error_rows.append(row + [f"Row {row_number}: One or more fields are empty"])
-            continue
-
-        # File-specific validations.
-        if file_name == "hired_employees.csv":
-            try:
-                id_val = int(row[0])
-                name_val = row[1]
-                datetime_str = row[2]
-                # Validate datetime format (adjust for the 'Z' if needed).
-                try:
-                    datetime.fromisoformat(datetime_str.replace("Z", "+00:00"))
-                except Exception:
-                    raise ValueError(f"Invalid datetime format: {datetime_str}")
-                department_id_val = int(row[3])
-                job_id_val = int(row[4])
-                valid_objects.append(model(
-                    id=id_val,
-                    name=name_val,
-                    datetime=datetime_str,
-                    department_id=department_id_val,
-                    job_id=job_id_val
-                ))
-            except Exception as e:
-                error_rows.append(row + [f"Row {row_number}: {e}"])
-                continue
-
-        elif file_name == "departments.csv":
-            try:
-                id_val = int(row[0])
-                department_val = row[1]
-                valid_objects.append(model(
-                    id=id_val,
-                    department=department_val
-                ))
-            except Exception as e:
-                error_rows.append(row + [f"Row {row_number}: {e}"])
-                continue
-
-        elif file_name == "jobs.csv":
-            try:
-                id_val = int(row[0])
-                job_val = row[1]
-                valid_objects.append(model(
-                    id=id_val,
-                    job=job_val
-                ))
-            except Exception as e:
-                error_rows.append(row + [f"Row {row_number}: {e}"])
-                continue
-
-    # Insert valid rows in a batch transaction.
-    db = SessionLocal()
+    blocks = iter_validated_blocks(file, file_name)
     try:
-        if valid_objects:
-            db.bulk_save_objects(valid_objects)
-            db.commit()
-    except Exception as db_error:
-        db.rollback()
-        raise HTTPException(status_code=500, detail=f"Database error: {db_error}")
+        async for row_count, valid_rows, errors in blocks:
+            first_row_number = next_row_number
+            next_row_number += row_count
+
+            # Limit to 1,000 rows per request; stop reading as soon as it is exceeded.
+            if not stream and next_row_number - first_row > MAX_ROWS_PER_REQUEST:
+                raise HTTPException(
+                    status_code=400, 
+                    detail=f"Maximum of {MAX_ROWS_PER_REQUEST} rows allowed per request."
+                )
+
+            # Errors are compressed into the error sink as they are found.
+            if errors:
+                error_sink.write_rows(error_rows(errors, first_row_number))
+                error_count += len(errors)
+
+            # Insert valid rows in batch transactions.
+            pending_rows.extend(valid_rows)
+            while batch_limit and len(pending_rows) >= batch_limit:
+                batch, pending_rows = pending_rows[:batch_limit], pending_rows[batch_limit:]
+                await loop.run_in_executor(io_pool, insert_rows, file_name, batch, mode, None, shadow)
+                inserted_rows += len(batch)
+
+            if progress is not None:
+                progress(next_row_number - first_row, inserted_rows, error_count)
+
+        if pending_rows:
+            await loop.run_in_executor(io_pool, insert_rows, file_name, pending_rows, mode, None, shadow)
+            inserted_rows += len(pending_rows)
+            if progress is not None:
+                progress(next_row_number - first_row, inserted_rows, error_count)
+
+        if mode == "replace":
+            with stage_timer("ingest", "swap", table=table_name):
+                await loop.run_in_executor(io_pool, _run_in_transaction, swap_shadow_table, table_name, shadow)
+        if file_name == "hired_employees.csv" and mode == "replace":
+            with stage_timer("ingest", "summary", table=table_name):
+                await loop.run_in_executor(io_pool, _run_in_transaction, rebuild_hires_summary)
+        if mode != "insert":
+            await loop.run_in_executor(io_pool, invalidate_reference_ids, table_name)
+            await loop.run_in_executor(io_pool, bump_data_version)
+    except Exception:
+        error_sink.discard()
+        if mode == "replace":
+            await loop.run_in_executor(io_pool, _run_in_transaction, drop_shadow_table, shadow)
+        raise
+    finally:
+        await blocks.aclose()
+
+    count_rows("ingest", inserted_rows, table=table_name, outcome="inserted")
+    count_rows("ingest", error_count, table=table_name, outcome="error")
+    record_throughput("ingest", inserted_rows + error_count, time.perf_counter() - started, table=table_name)
+
+    # Upload the error file to S3 without holding up the response.
+    error_file = None
+    if error_count:
+        io_pool.submit(error_sink.upload)
+        error_file = error_sink.key
+    else:
+        error_sink.discard()
+
+    return {"inserted_rows": inserted_rows, "error_rows": error_count, "error_file": error_file}
+
+async def process_upload(file, stream: bool = False, batch_size: Optional[int] = None, mode: str = "insert", first_row: int = 1, progress=None):
+    """
+    Processes an upload that may be compressed or hold several table files.
+    Plain CSVs go straight to process_csv_file. gzip/zstd files are
+    decompressed as they are read and return the same result. Zip archives
+    are processed member by member, departments and jobs before
+    hired_employees, and return each member's result under "files" together
+    with the totals.
+    """
+    check_upload(file.filename, mode)
+    loop = asyncio.get_running_loop()
+    members = await loop.run_in_executor(get_thread_pool(), open_upload_members, file.filename, file.file, list(FILE_CONFIG))
+    if members is None:
+        return await process_csv_file(file, stream, batch_size, mode, first_row, progress)
+
+    results = {}
+    done = {"rows": 0, "inserted_rows": 0, "error_rows": 0}
+    try:
+        for member in members:
+            member_progress = None
+            if progress is not None:
+                def member_progress(rows, inserted_rows, error_rows):
+                    progress(done["rows"] + rows, done["inserted_rows"] + inserted_rows, done["error_rows"] + error_rows)
+            result = await process_csv_file(member, stream, batch_size, mode, first_row, member_progress)
+            results[member.filename] = result
+            done["rows"] += result["inserted_rows"] + result["error_rows"]
+            done["inserted_rows"] += result["inserted_rows"]
+            done["error_rows"] += result["error_rows"]
     finally:
-        db.close()
-
-    # Write errors to a temporary CSV file and upload it to S3.
-    if error_rows:
-        error_file_name = f"errors_{file_name}"
-        with tempfile.NamedTemporaryFile(mode="w+", delete=False, newline='', suffix=".csv") as temp_file:
-            writer = csv.writer(temp_file)
-            header = config["fields"] + ["error_message"]
-            writer.writerow(header)
-            for error_row in error_rows:
-                writer.writerow(error_row)
-            temp_file_path = temp_file.name
-        upload_error_file_to_s3(temp_file_path, error_file_name)
-
-    return {"inserted_rows": len(valid_objects), "error_rows": len(error_rows)}
+        for member in members:
+            await member.close()
+
+    if upload_kind(file.filename)[0] != "zip":
+        return results[members[0].filename]
+    return {
+        "inserted_rows": done["inserted_rows"],
+        "error_rows": done["error_rows"],
+        "error_files": [r["error_file"] for r in results.values() if r["error_file"]],
+        "files": results,
+    }
+
+def _run_in_transaction(operation, *args):
+    with engine.begin() as connection:
+        return operation(connection, *args)
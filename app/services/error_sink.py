@@ -0,0 +1,79 @@
+# services/error_sink.py
+import csv
+import gzip
+import io
+import os
+import tempfile
+import uuid
+from datetime import datetime, timezone
+
+from services.aws import get_s3_client
+from services.metrics import count_bytes, stage_timer
+
+# Error rows are kept in memory up to this size before spilling to disk.
+ERROR_SINK_MEMORY_BYTES = int(os.getenv("ERROR_SINK_MEMORY_BYTES", str(8 * 1024 * 1024)))
+
+def error_file_key(table_name: str, request_id: str, now: datetime = None):
+    """Builds the S3 key of an error file: errors/<table>/<YYYY-MM-DD>/<request id>.csv.gz."""
+    now = now or datetime.now(timezone.utc)
+    return f"errors/{table_name}/{now:%Y-%m-%d}/{request_id}.csv.gz"
+
+class ErrorSink:
+    """
+    Collects the invalid rows of one upload as a gzip-compressed CSV.
+    The compressed data is held in memory and spills to a temporary file
+    when it grows past ERROR_SINK_MEMORY_BYTES; nothing is left on disk once
+    the sink is uploaded or discarded.
+    """
+
+    def __init__(self, bucket: str, table_name: str, header, request_id: str = None):
+        self.bucket = bucket
+        self.table_name = table_name
+        self.key = error_file_key(table_name, request_id or uuid.uuid4().hex)
+        self.header = header
+        self.row_count = 0
+        self._buffer = tempfile.SpooledTemporaryFile(max_size=ERROR_SINK_MEMORY_BYTES)
+        self._gzip = None
+        self._text = None
+        self._writer = None
+
+    def write_rows(self, rows):
+        """Appends error rows, writing the header before the first one."""
+        if self._writer is None:
+            self._gzip = gzip.GzipFile(fileobj=self._buffer, mode="wb")
+            self._text = io.TextIOWrapper(self._gzip, encoding="utf-8", newline="")
+            self._writer = csv.writer(self._text)
+            self._writer.writerow(self.header)
+        self._writer.writerows(rows)
+        self.row_count += len(rows)
+
+    def close(self):
+        """Finishes the gzip stream; call before upload."""
+        if self._text is not None:
+            # Detach so closing the wrapper does not close the spooled buffer.
+            self._text.flush()
+            self._text.detach()
+            self._gzip.close()
+            self._text = self._gzip = self._writer = None
+
+    def upload(self):
+        """Uploads the compressed error file to S3 and releases the buffer."""
+        try:
+            self.close()
+            size = self._buffer.tell()
+            self._buffer.seek(0)
+            with stage_timer("ingest", "error_upload", table=self.table_name):
+                get_s3_client().upload_fileobj(
+                    self._buffer, self.bucket, self.key,
+                    ExtraArgs={"ContentType": "text/csv", "ContentEncoding": "gzip"},
+                )
+            count_bytes("error_upload", size, table=self.table_name)
+        except Exception as e:
+            # In production, use proper logging instead of printing.
+            print(f"Error uploading file to S3: {e}")
+        finally:
+            self._buffer.close()
+
+    def discard(self):
+        """Drops the buffered rows without uploading them."""
+        self._buffer.close()
@@ -0,0 +1,39 @@
+# services/executors.py
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# Worker counts for CPU-bound parsing/validation and blocking DB/S3 calls.
+CPU_WORKERS = int(os.getenv("CPU_WORKERS", str(os.cpu_count() or 1)))
+IO_WORKERS = int(os.getenv("IO_WORKERS", "8"))
+
+_process_pool = None
+_thread_pool = None
+
+def get_process_pool():
+    """
+    Returns the shared process pool, creating it on first use.
+    Workers are spawned rather than forked so they never inherit the API
+    process's threads, sockets or pooled DB connections.
+    """
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(max_workers=CPU_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _process_pool
+
+def get_thread_pool():
+    """Returns the shared thread pool for blocking I/O, creating it on first use."""
+    global _thread_pool
+    if _thread_pool is None:
+        _thread_pool = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io")
+    return _thread_pool
+
+def shutdown_executors():
+    """Shuts down both pools; called when the application stops."""
+    global _process_pool, _thread_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=True)
+        _process_pool = None
+    if _thread_pool is not None:
+        _thread_pool.shutdown(wait=True)
+        _thread_pool = None
@@ -0,0 +1,89 @@
+# services/hires_summary.py
+from collections import Counter
+
+from sqlalchemy import select
+
+from models import HiredEmployee, HiresSummary
+
+SUMMARY_TABLE = HiresSummary.__tablename__
+# Ids looked up per query when collecting the rows an upsert overwrites.
+REPLACED_IDS_PER_QUERY = 1000
+
+def summarize_hires(rows, hired_at_index: int, department_index: int, job_index: int):
+    """
+    Counts hires per (year, quarter, department_id, job_id) in a batch of row tuples.
+    Rows without a hire datetime are skipped.
+    """
+    counts = Counter()
+    for row in rows:
+        hired_at = row[hired_at_index]
+        if hired_at is not None:
+            counts[(hired_at.year, (hired_at.month - 1) // 3 + 1, row[department_index], row[job_index])] += 1
+    return counts
+
+def replaced_hire_counts(connection, ids):
+    """
+    Counts the hires of the hired_employees rows with the given ids as they
+    are now, i.e. before an upsert overwrites them. On MySQL the rows are
+    locked until the caller's transaction ends, so concurrent upserts of the
+    same ids cannot both subtract the old counts.
+    """
+    table = HiredEmployee.__table__
+    counts = Counter()
+    ids = list(ids)
+    for start in range(0, len(ids), REPLACED_IDS_PER_QUERY):
+        query = (
+            select(table.c.hired_at, table.c.department_id, table.c.job_id)
+            .where(table.c.id.in_(ids[start:start + REPLACED_IDS_PER_QUERY]))
+            .with_for_update()
+        )
+        counts.update(summarize_hires(connection.execute(query).fetchall(), 0, 1, 2))
+    return counts
+
+def apply_hire_counts(connection, counts):
+    """
+    Adds a batch's hire counts to the summary table on the caller's
+    transaction. Counts may be negative (rows overwritten by an upsert);
+    summary rows left with no hires are deleted.
+    """
+    counts = {key: hires for key, hires in counts.items() if hires}
+    if not counts:
+        return
+    if connection.dialect.name == "mysql":
+        sql = (
+            f"INSERT INTO {SUMMARY_TABLE} (year, quarter, department_id, job_id, hires) "
+            "VALUES (%s, %s, %s, %s, %s) ON DUPLICATE KEY UPDATE hires = hires + VALUES(hires)"
+        )
+        delete = (
+            f"DELETE FROM {SUMMARY_TABLE} "
+            "WHERE year = %s AND quarter = %s AND department_id = %s AND job_id = %s AND hires <= 0"
+        )
+    else:
+        sql = (
+            f"INSERT INTO {SUMMARY_TABLE} (year, quarter, department_id, job_id, hires) "
+            "VALUES (?, ?, ?, ?, ?) ON CONFLICT (year, quarter, department_id, job_id) "
+            "DO UPDATE SET hires = hires + excluded.hires"
+        )
+        delete = (
+            f"DELETE FROM {SUMMARY_TABLE} "
+            "WHERE year = ? AND quarter = ? AND department_id = ? AND job_id = ? AND hires <= 0"
+        )
+    connection.exec_driver_sql(sql, [key + (hires,) for key, hires in counts.items()])
+    emptied = [key for key, hires in counts.items() if hires < 0]
+    if emptied:
+        connection.exec_driver_sql(delete, emptied)
+
+def rebuild_hires_summary(connection):
+    """Recomputes the whole summary table from hired_employees."""
+    if connection.dialect.name == "mysql":
+        year, quarter = "YEAR(hired_at)", "QUARTER(hired_at)"
+    else:
+        year = "CAST(strftime('%Y', hired_at) AS INTEGER)"
+        quarter = "(CAST(strftime('%m', hired_at) AS INTEGER) + 2) / 3"
+    connection.exec_driver_sql(f"DELETE FROM {SUMMARY_TABLE}")
+    connection.exec_driver_sql(
+        f"INSERT INTO {SUMMARY_TABLE} (year, quarter, department_id, job_id, hires) "
+        f"SELECT {year}, {quarter}, department_id, job_id, COUNT(*) "
+        "FROM hired_employees WHERE hired_at IS NOT NULL "
+        f"GROUP BY {year}, {quarter}, department_id, job_id"
+    )
@@ -0,0 +1,80 @@
+# services/idempotency.py
+import json
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+from fastapi import HTTPException
+from sqlalchemy.exc import IntegrityError
+
+from db import engine
+from models import IngestRequest
+
+# Hours a finished request's result is kept for replays.
+IDEMPOTENCY_TTL_HOURS = float(os.getenv("IDEMPOTENCY_TTL_HOURS", "24"))
+# Seconds after which a request still marked running is assumed dead and may be retried.
+IDEMPOTENCY_LOCK_SECONDS = float(os.getenv("IDEMPOTENCY_LOCK_SECONDS", "900"))
+# Minimum seconds between purges of expired keys.
+PURGE_INTERVAL = 60
+
+requests_table = IngestRequest.__table__
+
+_last_purge = 0.0
+
+def _now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def create_idempotency_table():
+    requests_table.create(bind=engine, checkfirst=True)
+
+def _purge_expired(connection):
+    global _last_purge
+    if time.monotonic() - _last_purge < PURGE_INTERVAL:
+        return
+    _last_purge = time.monotonic()
+    cutoff = _now() - timedelta(hours=IDEMPOTENCY_TTL_HOURS)
+    connection.execute(requests_table.delete().where(requests_table.c.created_at < cutoff))
+
+def claim_request(key: str):
+    """
+    Claims an idempotency key before its upload is processed.
+    Returns the stored response if the key already completed, None if the
+    caller now owns the key, and raises a 409 while another request with the
+    same key is still running.
+    """
+    now = _now()
+    try:
+        with engine.begin() as connection:
+            _purge_expired(connection)
+            connection.execute(requests_table.insert(), {"key": key, "status": "running", "created_at": now})
+        return None
+    except IntegrityError:
+        pass
+    with engine.begin() as connection:
+        row = connection.execute(requests_table.select().where(requests_table.c.key == key)).mappings().first()
+        if row is None:
+            # Released in the meantime: retry the claim.
+            return claim_request(key)
+        if row["status"] == "done":
+            return json.loads(row["result"])
+        stale = now - timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS)
+        taken = connection.execute(
+            requests_table.update()
+            .where(requests_table.c.key == key, requests_table.c.status == "running", requests_table.c.created_at < stale)
+            .values(created_at=now)
+        ).rowcount
+    if not taken:
+        raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is already being processed")
+    return None
+
+def complete_request(key: str, result: dict):
+    """Stores the response of a claimed key so repeats of the request get it back."""
+    with engine.begin() as connection:
+        connection.execute(
+            requests_table.update().where(requests_table.c.key == key).values(status="done", result=json.dumps(result))
+        )
+
+def release_request(key: str):
+    """Forgets a claimed key whose request failed, so it can be retried."""
+    with engine.begin() as connection:
+        connection.execute(requests_table.delete().where(requests_table.c.key == key))
@@ -0,0 +1,279 @@
+# services/ingest_jobs.py
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from fastapi import HTTPException, UploadFile
+from sqlalchemy import func, inspect
+from starlette.concurrency import run_in_threadpool
+
+from db import engine
+from models import IngestJob
+from services.aws import get_s3_client, raw_data_bucket
+from services.csv_processor import check_upload, process_upload
+from services.executors import get_thread_pool
+
+# Jobs run at the same time by this process.
+INGEST_JOB_WORKERS = int(os.getenv("INGEST_JOB_WORKERS", "2"))
+# Seconds an idle worker waits before looking for queued jobs again.
+INGEST_JOB_POLL = float(os.getenv("INGEST_JOB_POLL", "1"))
+# Minimum seconds between progress writes for a running job.
+INGEST_JOB_PROGRESS_INTERVAL = float(os.getenv("INGEST_JOB_PROGRESS_INTERVAL", "1"))
+# Seconds between heartbeats of a running job. A running job without one for
+# INGEST_JOB_STALE_SECONDS was left behind by a process that died.
+INGEST_JOB_HEARTBEAT = float(os.getenv("INGEST_JOB_HEARTBEAT", "30"))
+INGEST_JOB_STALE_SECONDS = float(os.getenv("INGEST_JOB_STALE_SECONDS", "300"))
+# Directory uploads are spooled to until their job runs.
+INGEST_JOB_DIR = os.getenv("INGEST_JOB_DIR", os.path.join(tempfile.gettempdir(), "ingest_jobs"))
+# Bytes copied at a time when spooling an upload.
+SPOOL_CHUNK_SIZE = 1024 * 1024
+
+jobs_table = IngestJob.__table__
+
+_workers = []
+_wake = None
+
+def _now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+class S3Upload:
+    """Read-only stand-in for UploadFile that streams an S3 object."""
+
+    def __init__(self, bucket: str, key: str):
+        self.filename = os.path.basename(key)
+        self.file = get_s3_client().get_object(Bucket=bucket, Key=key)["Body"]
+
+    async def read(self, size: int = -1):
+        return await asyncio.get_running_loop().run_in_executor(get_thread_pool(), self.file.read, size)
+
+    async def close(self):
+        self.file.close()
+
+def _insert_job(job_id: str, file_name: str, source: str, location: str, mode: str, batch_size: Optional[int]):
+    with engine.begin() as connection:
+        connection.execute(jobs_table.insert(), {
+            "id": job_id, "file_name": file_name, "source": source, "location": location,
+            "mode": mode, "batch_size": batch_size, "status": "queued",
+            "rows_processed": 0, "inserted_rows": 0, "error_rows": 0, "created_at": _now(),
+        })
+
+def _spool_upload(file):
+    os.makedirs(INGEST_JOB_DIR, exist_ok=True)
+    path = os.path.join(INGEST_JOB_DIR, uuid.uuid4().hex)
+    with open(path, "wb") as spool:
+        shutil.copyfileobj(file, spool, SPOOL_CHUNK_SIZE)
+    return path
+
+async def submit_upload(file: UploadFile, mode: str = "insert", batch_size: Optional[int] = None):
+    """Spools an uploaded file to disk and queues it. Returns the job id."""
+    check_upload(file.filename, mode)
+    path = await run_in_threadpool(_spool_upload, file.file)
+    job_id = uuid.uuid4().hex
+    await run_in_threadpool(_insert_job, job_id, file.filename, "upload", path, mode, batch_size)
+    _notify()
+    return job_id
+
+async def submit_s3(key: str, mode: str = "insert", batch_size: Optional[int] = None):
+    """Queues an object of the raw data bucket. Returns the job id."""
+    check_upload(os.path.basename(key), mode)
+    job_id = uuid.uuid4().hex
+    await run_in_threadpool(_insert_job, job_id, os.path.basename(key), "s3", key, mode, batch_size)
+    _notify()
+    return job_id
+
+def get_job(job_id: str):
+    """Returns a job's state with its throughput in rows per second, or None."""
+    with engine.connect() as connection:
+        row = connection.execute(jobs_table.select().where(jobs_table.c.id == job_id)).mappings().first()
+    if row is None:
+        return None
+    job = dict(row)
+    job.pop("location")
+    elapsed = None
+    if job["started_at"] is not None:
+        elapsed = ((job["finished_at"] or _now()) - job["started_at"]).total_seconds()
+    job["elapsed_seconds"] = elapsed
+    job["rows_per_second"] = round(job["rows_processed"] / elapsed, 1) if elapsed else None
+    return job
+
+def _claim_next_job():
+    """
+    Marks the oldest queued job as running and returns it, or None if the
+    queue is empty. The status check in the UPDATE keeps two workers (or two
+    API processes) from claiming the same job.
+    """
+    with engine.begin() as connection:
+        candidates = connection.execute(
+            jobs_table.select()
+            .where(jobs_table.c.status == "queued")
+            .order_by(jobs_table.c.created_at)
+            .limit(5)
+        ).mappings().all()
+        for job in candidates:
+            claimed = connection.execute(
+                jobs_table.update()
+                .where(jobs_table.c.id == job["id"], jobs_table.c.status == "queued")
+                .values(status="running", started_at=_now(), heartbeat_at=_now())
+            ).rowcount
+            if claimed:
+                return dict(job)
+    return None
+
+def _update_job(job_id: str, **values):
+    with engine.begin() as connection:
+        connection.execute(jobs_table.update().where(jobs_table.c.id == job_id).values(**values))
+
+def release_interrupted_job(job: dict):
+    """
+    Takes a job that stopped before finishing out of the running state.
+    Upsert and replace jobs can safely run again, so they are queued again if
+    their file is still there; anything else is marked failed and its spool
+    file deleted. Returns the new status.
+    """
+    source_left = job["source"] == "s3" or os.path.exists(job["location"])
+    if job["mode"] != "insert" and source_left:
+        values = {"status": "queued", "started_at": None, "heartbeat_at": None, "rows_processed": 0, "inserted_rows": 0, "error_rows": 0}
+    else:
+        if job["source"] == "upload" and source_left:
+            os.remove(job["location"])
+        values = {"status": "failed", "finished_at": _now(), "error": "Interrupted before it finished; upload the file again"}
+    with engine.begin() as connection:
+        connection.execute(
+            jobs_table.update().where(jobs_table.c.id == job["id"], jobs_table.c.status == "running").values(**values)
+        )
+    return values["status"]
+
+def recover_stale_jobs():
+    """
+    Releases running jobs whose heartbeat stopped more than
+    INGEST_JOB_STALE_SECONDS ago, i.e. jobs of a process that crashed or was
+    killed. Returns the number of jobs released.
+    """
+    cutoff = _now() - timedelta(seconds=INGEST_JOB_STALE_SECONDS)
+    last_seen = func.coalesce(jobs_table.c.heartbeat_at, jobs_table.c.started_at, jobs_table.c.created_at)
+    with engine.connect() as connection:
+        stale = connection.execute(
+            jobs_table.select().where(jobs_table.c.status == "running", last_seen < cutoff)
+        ).mappings().all()
+    for job in stale:
+        status = release_interrupted_job(dict(job))
+        print(f"Ingest job {job['id']} ({job['file_name']}) was interrupted; now {status}")
+    return len(stale)
+
+async def _heartbeat(job_id: str):
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(INGEST_JOB_HEARTBEAT)
+        try:
+            await loop.run_in_executor(get_thread_pool(), lambda: _update_job(job_id, heartbeat_at=_now()))
+        except Exception as e:
+            print(f"Ingest job {job_id} heartbeat failed: {e}")
+
+async def run_job(job: dict):
+    """
+    Runs one claimed job through process_upload and records its outcome.
+    If the job is cancelled (shutdown), it is released with
+    release_interrupted_job instead.
+    """
+    loop = asyncio.get_running_loop()
+    io_pool = get_thread_pool()
+    last_write = 0.0
+    pending_write = None
+
+    def progress(rows_processed, inserted_rows, error_rows):
+        # Written from the thread pool, at most one write in flight at a time.
+        nonlocal last_write, pending_write
+        now = time.monotonic()
+        if now - last_write >= INGEST_JOB_PROGRESS_INTERVAL and (pending_write is None or pending_write.done()):
+            last_write = now
+            pending_write = io_pool.submit(
+                _update_job, job["id"],
+                rows_processed=rows_processed, inserted_rows=inserted_rows, error_rows=error_rows,
+            )
+
+    heartbeat = asyncio.create_task(_heartbeat(job["id"]))
+    interrupted = False
+    file = None
+    try:
+        if job["source"] == "s3":
+            file = await loop.run_in_executor(io_pool, S3Upload, raw_data_bucket(), job["location"])
+        else:
+            file = UploadFile(open(job["location"], "rb"), filename=job["file_name"])
+        result = await process_upload(
+            file, stream=True, batch_size=job["batch_size"], mode=job["mode"], progress=progress,
+        )
+        outcome = {
+            "status": "done",
+            "rows_processed": result["inserted_rows"] + result["error_rows"],
+            "inserted_rows": result["inserted_rows"],
+            "error_rows": result["error_rows"],
+            "error_file": result.get("error_file") or ",".join(result.get("error_files", [])) or None,
+        }
+    except asyncio.CancelledError:
+        interrupted = True
+        raise
+    except Exception as e:
+        outcome = {"status": "failed", "error": e.detail if isinstance(e, HTTPException) else str(e)}
+    finally:
+        heartbeat.cancel()
+        if file is not None:
+            await file.close()
+        if interrupted:
+            print(f"Ingest job {job['id']} ({job['file_name']}) interrupted; now {release_interrupted_job(job)}")
+        elif job["source"] == "upload" and os.path.exists(job["location"]):
+            os.remove(job["location"])
+    if pending_write is not None:
+        await asyncio.wrap_future(pending_write)
+    await loop.run_in_executor(io_pool, lambda: _update_job(job["id"], finished_at=_now(), **outcome))
+    print(f"Ingest job {job['id']} ({job['file_name']}) {outcome['status']}")
+
+async def _worker():
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            job = await loop.run_in_executor(get_thread_pool(), _claim_next_job)
+            if job is None:
+                _wake.clear()
+                try:
+                    await asyncio.wait_for(_wake.wait(), INGEST_JOB_POLL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await run_job(job)
+        except Exception as e:
+            # A failed database call must not stop the queue; a job left
+            # running is picked up by recover_stale_jobs at the next start.
+            print(f"Ingest worker error: {e}")
+            await asyncio.sleep(INGEST_JOB_POLL)
+
+def _notify():
+    if _wake is not None:
+        _wake.set()
+
+def start_ingest_workers(count: int = INGEST_JOB_WORKERS):
+    """
+    Creates the ingest_jobs table if needed, releases jobs left running by a
+    process that died, and starts the workers; call from the running loop.
+    """
+    global _wake
+    jobs_table.create(bind=engine, checkfirst=True)
+    if "heartbeat_at" not in {c["name"] for c in inspect(engine).get_columns("ingest_jobs")}:
+        # Tables created before jobs had heartbeats.
+        with engine.begin() as connection:
+            connection.exec_driver_sql("ALTER TABLE ingest_jobs ADD COLUMN heartbeat_at DATETIME NULL")
+    recover_stale_jobs()
+    _wake = asyncio.Event()
+    for _ in range(count):
+        _workers.append(asyncio.create_task(_worker()))
+
+async def stop_ingest_workers():
+    """Cancels the workers; jobs interrupted here are queued again or marked failed."""
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
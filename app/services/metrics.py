@@ -0,0 +1,239 @@
+# services/metrics.py
+import functools
+import inspect
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from sqlalchemy import event
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+# Instrumentation is off unless METRICS_ENABLED=true; when off, timers are a
+# shared no-op and decorated functions are returned unwrapped.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "false").lower() == "true"
+# Statements slower than this many seconds are logged.
+SLOW_QUERY_SECONDS = float(os.getenv("SLOW_QUERY_SECONDS", "1"))
+
+# Histogram bucket upper bounds, in seconds.
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+HELP = {
+    "pipeline_stage_seconds": ("histogram", "Time spent in each stage of the ingest, backup, restore and report pipelines."),
+    "pipeline_rows_total": ("counter", "Rows handled by each pipeline."),
+    "pipeline_bytes_total": ("counter", "Bytes read or written by each pipeline."),
+    "pipeline_rows_per_second": ("gauge", "Throughput of the most recent run of each pipeline."),
+    "db_pool_checkout_seconds": ("histogram", "Time spent waiting for a pooled database connection."),
+    "db_query_seconds": ("histogram", "Database statement execution time."),
+    "db_slow_queries_total": ("counter", "Statements slower than SLOW_QUERY_SECONDS."),
+}
+
+
+class MetricsRegistry:
+    """Counters, gauges and histograms keyed by metric name and label values."""
+
+    def __init__(self):
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(BUCKETS), 0.0, 0]
+            index = bisect_left(BUCKETS, value)
+            if index < len(BUCKETS):
+                histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format."""
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            histograms = {key: (list(h[0]), h[1], h[2]) for key, h in self._histograms.items()}
+
+        lines = []
+        described = set()
+
+        def describe(name):
+            if name not in described:
+                described.add(name)
+                kind, text = HELP.get(name, ("untyped", name))
+                lines.append(f"# HELP {name} {text}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for values in (counters, gauges):
+            for (name, labels), value in sorted(values.items()):
+                describe(name)
+                lines.append(f"{name}{_labels(labels)} {value}")
+        for (name, labels), (buckets, total, count) in sorted(histograms.items()):
+            describe(name)
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS, buckets):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{_labels(labels)} {total}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+
+registry = MetricsRegistry()
+
+
+class _NullTimer:
+    elapsed = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+
+class StageTimer:
+    """Context manager that records its duration in pipeline_stage_seconds."""
+
+    def __init__(self, pipeline: str, stage: str, labels: dict):
+        self.pipeline = pipeline
+        self.stage = stage
+        self.labels = labels
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self._start
+        registry.observe("pipeline_stage_seconds", self.elapsed, pipeline=self.pipeline, stage=self.stage, **self.labels)
+        return False
+
+
+def stage_timer(pipeline: str, stage: str, **labels):
+    """Times a block as one stage of a pipeline; a no-op when metrics are disabled."""
+    if not METRICS_ENABLED:
+        return _NULL_TIMER
+    return StageTimer(pipeline, stage, labels)
+
+
+def observe_stage(pipeline: str, stage: str, seconds: float, **labels):
+    """Records a stage duration measured elsewhere, e.g. in a worker process."""
+    if METRICS_ENABLED:
+        registry.observe("pipeline_stage_seconds", seconds, pipeline=pipeline, stage=stage, **labels)
+
+
+def count_rows(pipeline: str, rows: int, **labels):
+    if METRICS_ENABLED and rows:
+        registry.inc("pipeline_rows_total", rows, pipeline=pipeline, **labels)
+
+
+def count_bytes(pipeline: str, size: int, **labels):
+    if METRICS_ENABLED and size:
+        registry.inc("pipeline_bytes_total", size, pipeline=pipeline, **labels)
+
+
+def record_throughput(pipeline: str, rows: int, seconds: float, **labels):
+    """Sets the rows/sec gauge for a finished pipeline run."""
+    if METRICS_ENABLED and seconds > 0:
+        registry.set("pipeline_rows_per_second", rows / seconds, pipeline=pipeline, **labels)
+
+
+def timed(pipeline: str, stage: str, **labels):
+    """
+    Decorator timing every call of a function or coroutine function as a
+    pipeline stage. Returns the function unchanged when metrics are disabled.
+    """
+    def decorate(func):
+        if not METRICS_ENABLED:
+            return func
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with StageTimer(pipeline, stage, labels):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with StageTimer(pipeline, stage, labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+class _CheckoutTimer:
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            registry.observe("db_pool_checkout_seconds", time.perf_counter() - start, pool=self._metrics_name)
+
+
+class TimedQueuePool(_CheckoutTimer, QueuePool):
+    """QueuePool that records how long each checkout waits for a connection."""
+    _metrics_name = "sync"
+
+
+class TimedAsyncQueuePool(_CheckoutTimer, AsyncAdaptedQueuePool):
+    """AsyncAdaptedQueuePool that records how long each checkout waits for a connection."""
+    _metrics_name = "async"
+
+
+def pool_options(async_engine: bool = False):
+    """Extra create_engine options that time pool checkouts when metrics are enabled."""
+    if not METRICS_ENABLED:
+        return {}
+    return {"poolclass": TimedAsyncQueuePool if async_engine else TimedQueuePool}
+
+
+def instrument_engine(engine, name: str):
+    """Times every statement run through engine and logs the slow ones."""
+    if not METRICS_ENABLED:
+        return
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        registry.observe("db_query_seconds", elapsed, engine=name)
+        if elapsed >= SLOW_QUERY_SECONDS:
+            registry.inc("db_slow_queries_total", engine=name)
+            print(f"Slow query ({elapsed:.3f}s, {name}): {' '.join(statement.split())[:500]}")
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        if context.connection is not None and context.connection.info.get("query_start"):
+            context.connection.info["query_start"].pop()
+
+
+def render_metrics():
+    return registry.render()
@@ -1,35 +1,101 @@
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from sqlalchemy import text
 
-def fetch_hired_employees_per_quarter(db: Session):
+from db import async_engine
+from services.metrics import timed
+
+FIELDNAMES = ["department", "job", "Q1", "Q2", "Q3", "Q4"]
+
+def build_query(after_cursor: bool = False, limited: bool = False):
     """
-    Fetches the number of employees hired in 2021 per quarter,
-    grouped by department and job, sorted alphabetically.
+    Builds the per-quarter report query. Reads the hires_summary table, so cost
+    depends on the number of department/job pairs rather than the number of
+    employees. after_cursor adds a keyset predicate on (department, job) and
+    limited a LIMIT, for pagination.
     """
-    query = text("""
+    sql = """
         SELECT d.department, j.job,
-               SUM(CASE WHEN QUARTER(he.datetime) = 1 THEN 1 ELSE 0 END) AS Q1,
-               SUM(CASE WHEN QUARTER(he.datetime) = 2 THEN 1 ELSE 0 END) AS Q2,
-               SUM(CASE WHEN QUARTER(he.datetime) = 3 THEN 1 ELSE 0 END) AS Q3,
-               SUM(CASE WHEN QUARTER(he.datetime) = 4 THEN 1 ELSE 0 END) AS Q4
-        FROM hired_employees he
-        JOIN departments d ON he.department_id = d.id
-        JOIN jobs j ON he.job_id = j.id
-        WHERE YEAR(he.datetime) = 2021
+               SUM(CASE WHEN hs.quarter = 1 THEN hs.hires ELSE 0 END) AS Q1,
+               SUM(CASE WHEN hs.quarter = 2 THEN hs.hires ELSE 0 END) AS Q2,
+               SUM(CASE WHEN hs.quarter = 3 THEN hs.hires ELSE 0 END) AS Q3,
+               SUM(CASE WHEN hs.quarter = 4 THEN hs.hires ELSE 0 END) AS Q4
+        FROM hires_summary hs
+        JOIN departments d ON hs.department_id = d.id
+        JOIN jobs j ON hs.job_id = j.id
+        WHERE hs.year = :year
+    """
+    if after_cursor:
+        sql += """
+          AND (d.department > :after_department
+               OR (d.department = :after_department AND j.job > :after_job))
+        """
+    sql += """
         GROUP BY d.department, j.job
-        ORDER BY d.department ASC, j.job ASC;
-    """)
-
-    result = db.execute(query).fetchall()
-
-    return [
-        {
-            "department": row[0],
-            "job": row[1],
-            "Q1": row[2],
-            "Q2": row[3],
-            "Q3": row[4],
-            "Q4": row[5],
-        }
-        for row in result
-    ]
+        ORDER BY d.department ASC, j.job ASC
+    """
+    if limited:
+        sql += " LIMIT :limit"
+    return text(sql)
+
+HIRED_EMPLOYEES_PER_QUARTER_QUERY = build_query()
+
+def _to_dict(row):
+    return {
+        "department": row[0],
+        "job": row[1],
+        "Q1": int(row[2]),
+        "Q2": int(row[3]),
+        "Q3": int(row[4]),
+        "Q4": int(row[5]),
+    }
+
+def _to_dicts(rows):
+    return [_to_dict(row) for row in rows]
+
+def _page_params(year: int, after=None, limit=None):
+    params = {"year": year}
+    if after is not None:
+        params["after_department"], params["after_job"] = after
+    if limit is not None:
+        params["limit"] = limit
+    return params
+
+@timed("report", "query", report="employees_hired_per_quarter")
+def fetch_hired_employees_per_quarter(db: Session, year: int = 2021):
+    """
+    Fetches the number of employees hired in the given year per quarter,
+    grouped by department and job, sorted alphabetically.
+    """
+    result = db.execute(HIRED_EMPLOYEES_PER_QUARTER_QUERY, {"year": year}).fetchall()
+    return _to_dicts(result)
+
+@timed("report", "query", report="employees_hired_per_quarter")
+async def fetch_hired_employees_per_quarter_async(db: AsyncSession, year: int = 2021):
+    """Async version of fetch_hired_employees_per_quarter."""
+    result = await db.execute(HIRED_EMPLOYEES_PER_QUARTER_QUERY, {"year": year})
+    return _to_dicts(result.fetchall())
+
+@timed("report", "query", report="employees_hired_per_quarter")
+async def fetch_hired_employees_per_quarter_page_async(db: AsyncSession, year: int, limit: int, after=None):
+    """
+    Fetches one page of the per-quarter report, starting after the
+    (department, job) pair in after. Returns the rows and the next pair to
+    resume from, or None on the last page.
+    """
+    query = build_query(after_cursor=after is not None, limited=True)
+    result = await db.execute(query, _page_params(year, after, limit))
+    items = _to_dicts(result.fetchall())
+    next_after = (items[-1]["department"], items[-1]["job"]) if len(items) == limit else None
+    return items, next_after
+
+async def stream_hired_employees_per_quarter(year: int = 2021, after=None):
+    """
+    Yields the per-quarter report row by row from a server-side cursor, on a
+    connection owned by the generator so it outlives the request's session.
+    """
+    query = build_query(after_cursor=after is not None)
+    async with async_engine.connect() as connection:
+        result = await connection.stream(query, _page_params(year, after))
+        async for row in result:
+            yield _to_dict(row)
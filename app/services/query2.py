@@ -0,0 +1,58 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from sqlalchemy import text
+
+from db import async_engine
+from services.metrics import timed
+
+FIELDNAMES = ["department_id", "department_name", "total_hires"]
+
+# Reads the hires_summary table instead of re-aggregating hired_employees.
+DEPARTMENTS_ABOVE_MEAN_HIRES_QUERY = text("""
+    WITH department_hires AS (
+        SELECT hs.department_id, d.department, SUM(hs.hires) AS total_hires
+        FROM hires_summary hs
+        JOIN departments d ON hs.department_id = d.id
+        WHERE hs.year = :year
+        GROUP BY hs.department_id, d.department
+    ),
+    avg_hires AS (
+        SELECT AVG(total_hires) AS mean_hires FROM department_hires
+    )
+    SELECT dh.department_id, dh.department, dh.total_hires
+    FROM department_hires dh
+    JOIN avg_hires ah ON dh.total_hires > ah.mean_hires
+    ORDER BY dh.total_hires DESC;
+""")
+
+def _to_dict(row):
+    return {
+        "department_id": row[0],
+        "department_name": row[1],
+        "total_hires": int(row[2]),
+    }
+
+def _to_dicts(rows):
+    return [_to_dict(row) for row in rows]
+
+@timed("report", "query", report="departments_above_mean_hires")
+def fetch_departments_above_mean_hires(db: Session, year: int = 2021):
+    """
+    Fetches departments that hired more employees than the mean in the given
+    year, ordered by number of hires (descending).
+    """
+    result = db.execute(DEPARTMENTS_ABOVE_MEAN_HIRES_QUERY, {"year": year}).fetchall()
+    return _to_dicts(result)
+
+@timed("report", "query", report="departments_above_mean_hires")
+async def fetch_departments_above_mean_hires_async(db: AsyncSession, year: int = 2021):
+    """Async version of fetch_departments_above_mean_hires."""
+    result = await db.execute(DEPARTMENTS_ABOVE_MEAN_HIRES_QUERY, {"year": year})
+    return _to_dicts(result.fetchall())
+
+async def stream_departments_above_mean_hires(year: int = 2021):
+    """Yields the report row by row from a server-side cursor on its own connection."""
+    async with async_engine.connect() as connection:
+        result = await connection.stream(DEPARTMENTS_ABOVE_MEAN_HIRES_QUERY, {"year": year})
+        async for row in result:
+            yield _to_dict(row)
@@ -0,0 +1,63 @@
+# services/reference_ids.py
+import os
+import threading
+import time
+
+import numpy as np
+
+from db import engine
+
+# Lookup tables whose ids hired_employees rows must reference.
+REFERENCE_TABLES = ("departments", "jobs")
+# How long a loaded id set is trusted before it is read again, so changes
+# made through other API workers are picked up too.
+REFERENCE_IDS_TTL = float(os.getenv("REFERENCE_IDS_TTL", "60"))
+
+
+class ReferenceIdCache:
+    """
+    Sorted arrays of the ids present in each lookup table, loaded on first
+    use and reloaded after invalidate() or once the TTL has passed.
+    """
+
+    def __init__(self, engine, ttl: float = REFERENCE_IDS_TTL):
+        self.engine = engine
+        self.ttl = ttl
+        self._ids = {}
+        self._lock = threading.Lock()
+
+    def get(self, table_name: str):
+        """Returns the sorted int64 array of ids in table_name."""
+        with self._lock:
+            entry = self._ids.get(table_name)
+            if entry is not None and time.monotonic() - entry[0] <= self.ttl:
+                return entry[1]
+        with self.engine.connect() as connection:
+            ids = connection.exec_driver_sql(f"SELECT id FROM {table_name}").scalars().all()
+        ids = np.unique(np.array(ids, dtype=np.int64))
+        with self._lock:
+            self._ids[table_name] = (time.monotonic(), ids)
+        return ids
+
+    def invalidate(self, table_name: str = None):
+        """Drops the cached ids of table_name (all tables if None)."""
+        with self._lock:
+            if table_name is None:
+                self._ids.clear()
+            else:
+                self._ids.pop(table_name, None)
+
+
+reference_ids = ReferenceIdCache(engine)
+
+def get_reference_ids(references: dict):
+    """
+    Maps each column of references (column -> lookup table) to the ids that
+    column may hold, in the form validate_batch expects.
+    """
+    return {column: reference_ids.get(table_name) for column, table_name in references.items()}
+
+def invalidate_reference_ids(table_name: str):
+    """Call after a lookup table is ingested or restored."""
+    if table_name in REFERENCE_TABLES:
+        reference_ids.invalidate(table_name)
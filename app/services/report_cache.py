@@ -0,0 +1,140 @@
+# services/report_cache.py
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from fastapi import Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from db import engine
+from models import DataVersion
+
+# "memory" keeps the data version in this process; "db" shares it between
+# uvicorn workers through the data_version table.
+REPORT_CACHE_VERSION_STORE = os.getenv("REPORT_CACHE_VERSION_STORE", "memory")
+REPORT_CACHE_SIZE = int(os.getenv("REPORT_CACHE_SIZE", "128"))
+REPORT_CACHE_TTL = float(os.getenv("REPORT_CACHE_TTL", "300"))
+# How long the db store trusts its last read before querying the version again.
+REPORT_CACHE_VERSION_POLL = float(os.getenv("REPORT_CACHE_VERSION_POLL", "1"))
+
+
+class MemoryVersionStore:
+    """
+    Data version counter held in process memory. Versions are prefixed with a
+    token drawn when the store is created, so an ETag issued before a restart
+    or by another worker never matches this process's data.
+    """
+
+    def __init__(self):
+        self._token = uuid.uuid4().hex
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        return f"{self._token}.{self._version}"
+
+    def bump(self):
+        with self._lock:
+            self._version += 1
+
+
+class DatabaseVersionStore:
+    """Data version counter stored in the data_version table, shared by all workers."""
+
+    def __init__(self, engine, poll_interval: float = REPORT_CACHE_VERSION_POLL):
+        self.engine = engine
+        self.poll_interval = poll_interval
+        self._version = None
+        self._read_at = 0.0
+        DataVersion.__table__.create(bind=engine, checkfirst=True)
+
+    def get(self):
+        now = time.monotonic()
+        if self._version is None or now - self._read_at >= self.poll_interval:
+            with self.engine.connect() as connection:
+                version = connection.exec_driver_sql("SELECT version FROM data_version WHERE id = 1").scalar()
+            self._version, self._read_at = version or 0, now
+        return self._version
+
+    def bump(self):
+        with self.engine.begin() as connection:
+            updated = connection.exec_driver_sql("UPDATE data_version SET version = version + 1 WHERE id = 1").rowcount
+            if not updated:
+                connection.execute(DataVersion.__table__.insert(), {"id": 1, "version": 1})
+        self._version = None
+
+
+class ReportCache:
+    """LRU cache of report results with a TTL, keyed by endpoint and parameters."""
+
+    def __init__(self, max_size: int = REPORT_CACHE_SIZE, ttl: float = REPORT_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if time.monotonic() - stored_at > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+_version_store = None
+report_cache = ReportCache()
+
+def get_version_store():
+    """Returns the configured data version store, creating it on first use."""
+    global _version_store
+    if _version_store is None:
+        if REPORT_CACHE_VERSION_STORE == "db":
+            _version_store = DatabaseVersionStore(engine)
+        else:
+            _version_store = MemoryVersionStore()
+    return _version_store
+
+def bump_data_version():
+    """Invalidates every cached report; call after data is inserted or restored."""
+    get_version_store().bump()
+
+def report_etag(endpoint: str, params: dict, version):
+    digest = hashlib.sha1(json.dumps([endpoint, params, version], sort_keys=True).encode()).hexdigest()
+    return f'W/"{digest}"'
+
+async def cached_report(request: Request, endpoint: str, params: dict, compute):
+    """
+    Serves a report from the cache, computing it with the async callable
+    compute on a miss. Responses carry an ETag tied to the data version, and
+    a matching If-None-Match gets an empty 304.
+    """
+    version = await run_in_threadpool(get_version_store().get)
+    etag = report_etag(endpoint, params, version)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    key = (endpoint, tuple(sorted(params.items())), version)
+    content = report_cache.get(key)
+    if content is None:
+        content = jsonable_encoder(await compute())
+        report_cache.set(key, content)
+    return JSONResponse(content, headers=headers)
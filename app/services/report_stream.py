@@ -0,0 +1,54 @@
+# services/report_stream.py
+import base64
+import csv
+import io
+import json
+
+from fastapi.responses import StreamingResponse
+
+STREAM_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+def encode_cursor(values):
+    """Encodes a keyset position as an opaque, URL-safe cursor string."""
+    return base64.urlsafe_b64encode(json.dumps(list(values)).encode()).decode()
+
+def decode_cursor(cursor: str, size: int):
+    """Decodes a cursor produced by encode_cursor. Raises ValueError if it is malformed."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError("Invalid cursor")
+    return values
+
+async def _ndjson_lines(rows):
+    async for row in rows:
+        yield json.dumps(row) + "\n"
+
+async def _csv_lines(rows, fieldnames):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fieldnames)
+    writer.writeheader()
+    async for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+def streaming_report(rows, output_format: str, fieldnames, filename: str):
+    """
+    Wraps an async iterator of row dicts in a StreamingResponse, encoding each
+    row as it arrives as NDJSON or CSV.
+    """
+    if output_format == "csv":
+        body = _csv_lines(rows, fieldnames)
+        headers = {"Content-Disposition": f'attachment; filename="{filename}.csv"'}
+    else:
+        body = _ndjson_lines(rows)
+        headers = {}
+    return StreamingResponse(body, media_type=STREAM_FORMATS[output_format], headers=headers)
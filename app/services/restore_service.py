@@ -1,72 +1,341 @@
 # services/restore_service.py
+import hashlib
+import json
 import os
-import boto3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 import fastavro
-from sqlalchemy.orm import Session
-from db import SessionLocal
-from models import HiredEmployee, Department, Job
+from sqlalchemy import select
+from db import engine
+from models import RestoreRun
+from services.backup_service import BACKUP_TABLES, backup_chain
+from services.bulk_insert import bulk_insert
+from services.hires_summary import rebuild_hires_summary
+from services.aws import backup_bucket, get_s3_client
+from services.metrics import count_bytes, count_rows, record_throughput, stage_timer
+from services.reference_ids import invalidate_reference_ids
+from services.report_cache import bump_data_version
+from services.table_utils import (
+    create_indexes, create_shadow_table, drop_secondary_indexes, drop_shadow_table,
+    swap_shadow_table,
+)
+from services.validation import parse_hire_datetime
 
-# AWS S3 Configuration
-S3_BUCKET = os.getenv("S3_BACKUP_BUCKET")
-if not S3_BUCKET:
-    raise RuntimeError("S3_BACKUP_BUCKET environment variable is not set.")
+# Target size of each insert batch; the row count is derived from the row width.
+RESTORE_BATCH_BYTES = int(os.getenv("RESTORE_BATCH_BYTES", str(4 * 1024 * 1024)))
+MIN_RESTORE_BATCH_ROWS = 100
+MAX_RESTORE_BATCH_ROWS = 50000
 
-s3_client = boto3.client("s3")
+# Part files loaded at the same time, each on its own connection.
+RESTORE_WORKERS = int(os.getenv("RESTORE_WORKERS", "4"))
 
-TABLE_SCHEMAS = {
-    "hired_employees": (HiredEmployee, "/tmp/hired_employees_backup.avro"),
-    "departments": (Department, "/tmp/departments_backup.avro"),
-    "jobs": (Job, "/tmp/jobs_backup.avro"),
-}
+# Tables restored together are swapped in this order, lookups first.
+RESTORE_ORDER = ("departments", "jobs", "hired_employees")
 
-def download_from_s3(s3_key: str, local_path: str):
+# Minimum seconds between progress writes of a running restore, and hours a
+# finished restore's progress is kept.
+RESTORE_PROGRESS_INTERVAL = float(os.getenv("RESTORE_PROGRESS_INTERVAL", "1"))
+RESTORE_PROGRESS_TTL_HOURS = float(os.getenv("RESTORE_PROGRESS_TTL_HOURS", "24"))
+
+restores_table = RestoreRun.__table__
+
+class HashingReader:
+    """Wraps a readable stream and computes the SHA-256 of everything read through it."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._sha256 = hashlib.sha256()
+
+    def read(self, size: int = -1):
+        data = self.stream.read(size)
+        self._sha256.update(data)
+        return data
+
+    def drain(self):
+        """Reads whatever the consumer left unread, so the digest covers the whole stream."""
+        while self.read(1024 * 1024):
+            pass
+
+    @property
+    def checksum(self):
+        return self._sha256.hexdigest()
+
+def restore_columns(table_name: str):
+    """Columns loaded on restore: the backup's fields plus derived typed columns."""
+    _, schema = BACKUP_TABLES[table_name]
+    columns = [field["name"] for field in schema["fields"]]
+    if table_name == "hired_employees":
+        columns.append("hired_at")
+    return columns
+
+def estimate_batch_rows(row, batch_bytes: int = None):
+    """Picks an insert batch size so each batch carries about batch_bytes of data."""
+    row_bytes = sum(len(str(value)) + 4 for value in row)
+    rows = (batch_bytes or RESTORE_BATCH_BYTES) // max(row_bytes, 1)
+    return max(MIN_RESTORE_BATCH_ROWS, min(MAX_RESTORE_BATCH_ROWS, rows))
+
+def iter_backup_rows(table_name: str, part: dict):
     """
-    Downloads a file from AWS S3 to a local path.
+    Streams the rows of one backup part straight from the S3 response body,
+    decoding Avro blocks as they arrive, and verifies the part's checksum once
+    it has been read.
     """
     try:
-        s3_client.download_file(S3_BUCKET, s3_key, local_path)
+        body = get_s3_client().get_object(Bucket=backup_bucket(), Key=part["key"])["Body"]
     except Exception as e:
         raise RuntimeError(f"Error downloading from S3: {e}")
 
-def restore_table_from_avro(table_name: str):
+    stream = HashingReader(body)
+    columns = restore_columns(table_name)
+    for record in fastavro.reader(stream):
+        if table_name == "hired_employees":
+            record["hired_at"] = parse_hire_datetime(record["datetime"])
+        yield tuple(record[c] for c in columns)
+
+    stream.drain()
+    if stream.checksum != part["sha256"]:
+        raise RuntimeError(f"Checksum mismatch for backup file {part['key']}")
+
+def load_parts_into_table(connection_factory, table_name: str, target: str, parts, progress: dict = None, on_batch=None):
     """
-    Restores data from an Avro backup file into the specified database table.
+    Inserts the rows of the given backup parts into the target table in
+    batches sized from the row width, committing each batch.
+    If progress is given, its "rows" entry is advanced after every batch,
+    and on_batch (if given) is called after that.
+    Returns the number of rows loaded.
     """
-    if table_name not in TABLE_SCHEMAS:
-        raise ValueError(f"Invalid table name: {table_name}")
+    columns = restore_columns(table_name)
+    restored = 0
+    batch = []
+    batch_rows = None
+    for part in parts:
+        for row in iter_backup_rows(table_name, part):
+            if batch_rows is None:
+                batch_rows = estimate_batch_rows(row)
+            batch.append(row)
+            if len(batch) >= batch_rows:
+                with stage_timer("restore", "insert", table=table_name), connection_factory() as connection:
+                    bulk_insert(connection, target, columns, batch)
+                restored += len(batch)
+                batch = []
+                if progress is not None:
+                    progress["rows"] = restored
+                if on_batch is not None:
+                    on_batch()
+        count_bytes("restore", part["bytes"], table=table_name)
+    if batch:
+        with stage_timer("restore", "insert", table=table_name), connection_factory() as connection:
+            bulk_insert(connection, target, columns, batch)
+        restored += len(batch)
+    if progress is not None:
+        progress["rows"] = restored
+    count_rows("restore", restored, table=table_name)
+    return restored
 
-    model, local_file_path = TABLE_SCHEMAS[table_name]
-    s3_key = f"backups/{table_name}_backup.avro"
+def _now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
 
-    # Step 1: Download Avro file from S3
-    download_from_s3(s3_key, local_file_path)
+def create_restores_table():
+    restores_table.create(bind=engine, checkfirst=True)
 
-    # Step 2: Read Avro data
-    records = []
-    with open(local_file_path, "rb") as avro_file:
-        avro_reader = fastavro.reader(avro_file)
-        for record in avro_reader:
-            records.append(record)
+def save_restore_progress(restore_id: str, progress: dict):
+    with engine.begin() as connection:
+        connection.execute(
+            restores_table.update().where(restores_table.c.id == restore_id)
+            .values(status=progress["status"], progress=json.dumps(progress), updated_at=_now())
+        )
 
-    if not records:
-        raise RuntimeError(f"No data found in Avro backup for table {table_name}")
+def new_restore(tables=None):
+    """
+    Registers a queued bulk restore and returns its id. Finished restores
+    older than RESTORE_PROGRESS_TTL_HOURS are deleted on the way.
+    """
+    restore_id = uuid.uuid4().hex
+    progress = {"restore_id": restore_id, "status": "queued", "tables": list(tables or BACKUP_TABLES)}
+    cutoff = _now() - timedelta(hours=RESTORE_PROGRESS_TTL_HOURS)
+    with engine.begin() as connection:
+        connection.execute(
+            restores_table.delete()
+            .where(restores_table.c.status.in_(["done", "failed"]), restores_table.c.updated_at < cutoff)
+        )
+        connection.execute(restores_table.insert(), {
+            "id": restore_id, "status": "queued", "progress": json.dumps(progress), "updated_at": _now(),
+        })
+    return restore_id
+
+def get_restore(restore_id: str):
+    """Returns the progress record of a bulk restore, or None."""
+    with engine.connect() as connection:
+        progress = connection.execute(
+            select(restores_table.c.progress).where(restores_table.c.id == restore_id)
+        ).scalar()
+    return json.loads(progress) if progress is not None else None
+
+@contextmanager
+def restore_connection(defer_checks: bool = False):
+    """
+    Opens a connection for one batch of restored rows and commits it on exit.
+    With defer_checks on MySQL, foreign-key and unique checks are switched
+    off for the session while loading and switched back on before the
+    connection returns to the pool; the rebuilt indexes check the data again
+    once the load is done.
+    """
+    with engine.connect() as connection:
+        deferred = defer_checks and connection.dialect.name == "mysql"
+        try:
+            # The SET runs inside the transaction: executing it first would
+            # autobegin one and begin() would then fail.
+            with connection.begin():
+                if deferred:
+                    connection.exec_driver_sql("SET foreign_key_checks = 0, unique_checks = 0")
+                yield connection
+        finally:
+            if deferred:
+                connection.exec_driver_sql("SET foreign_key_checks = 1, unique_checks = 1")
+                connection.commit()
+
+def restore_tables(tables=None, point_in_time: datetime = None, defer_checks: bool = False, restore_id: str = None):
+    """
+    Restores several tables from the Avro backups at the same time.
+    Every part file of every table is loaded into its table's shadow by up to
+    RESTORE_WORKERS workers, each on its own connection; once all parts are
+    in, indexes are rebuilt and the shadows are swapped in lookups first.
+    If restore_id (from new_restore) is given, progress per part is written
+    to the restores table while the restore runs, at most every
+    RESTORE_PROGRESS_INTERVAL seconds and on every status change.
+    Returns the progress record.
+    """
+    tables = list(tables or BACKUP_TABLES)
+    invalid = [t for t in tables if t not in BACKUP_TABLES]
+    if invalid:
+        raise ValueError(f"Invalid table name: {', '.join(invalid)}")
+    tables.sort(key=RESTORE_ORDER.index)
+
+    progress = {
+        "restore_id": restore_id,
+        "status": "running",
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "tables": tables,
+        "parts": [],
+    }
+    save_lock = threading.Lock()
+    last_save = 0.0
+
+    def save(force: bool = True):
+        # Workers update progress concurrently; one write at a time.
+        nonlocal last_save
+        if not restore_id:
+            return
+        with save_lock:
+            if not force and time.monotonic() - last_save < RESTORE_PROGRESS_INTERVAL:
+                return
+            last_save = time.monotonic()
+            try:
+                save_restore_progress(restore_id, progress)
+            except Exception as e:
+                print(f"Could not record progress of restore {restore_id}: {e}")
+
+    save()
+    try:
+        chain = backup_chain(point_in_time)
+    except RuntimeError as e:
+        progress.update({"status": "failed", "error": str(e)})
+        save()
+        raise
+    work = []
+    for table_name in tables:
+        for manifest in chain:
+            for part in manifest["tables"].get(table_name, {}).get("parts", []):
+                part_progress = {"table": table_name, "key": part["key"], "expected_rows": part["rows"], "rows": 0, "status": "pending"}
+                progress["parts"].append(part_progress)
+                work.append((table_name, part, part_progress))
+
+    def load(item):
+        table_name, part, part_progress = item
+        part_progress["status"] = "running"
+        save(force=False)
+        try:
+            load_parts_into_table(
+                lambda: restore_connection(defer_checks),
+                table_name, shadows[table_name], [part], part_progress, lambda: save(force=False),
+            )
+        except Exception:
+            part_progress["status"] = "failed"
+            raise
+        part_progress["status"] = "done"
+        save(force=False)
 
-    # Step 3: Insert into database
-    db: Session = SessionLocal()
+    # SQLite allows a single writer at a time.
+    workers = 1 if engine.dialect.name == "sqlite" else RESTORE_WORKERS
+    started = time.perf_counter()
+    shadows = {}
     try:
-        # Delete existing records
-        db.query(model).delete()
-        db.commit()
+        indexes = {}
+        with stage_timer("restore", "prepare"), engine.begin() as connection:
+            for table_name in tables:
+                shadows[table_name] = create_shadow_table(connection, table_name)
+                indexes[table_name] = drop_secondary_indexes(connection, shadows[table_name])
 
-        # Insert new records in batch
-        batch_size = 1000
-        for i in range(0, len(records), batch_size):
-            db.bulk_insert_mappings(model, records[i:i+batch_size])
-            db.commit()
+        with stage_timer("restore", "load"):
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="restore") as pool:
+                list(pool.map(load, work))
 
-        return f"Successfully restored {len(records)} records into {table_name}"
+        with engine.begin() as connection:
+            with stage_timer("restore", "index_rebuild"):
+                for table_name in tables:
+                    create_indexes(connection, shadows[table_name], indexes[table_name])
+            with stage_timer("restore", "swap"):
+                for table_name in tables:
+                    swap_shadow_table(connection, table_name, shadows[table_name])
+            if "hired_employees" in tables:
+                with stage_timer("restore", "summary"):
+                    rebuild_hires_summary(connection)
     except Exception as e:
-        db.rollback()
-        raise RuntimeError(f"Error restoring table {table_name}: {e}")
-    finally:
-        db.close()
+        with engine.begin() as connection:
+            for shadow in shadows.values():
+                drop_shadow_table(connection, shadow)
+        progress.update({"status": "failed", "error": str(e)})
+        save()
+        raise RuntimeError(f"Error restoring tables {', '.join(tables)}: {e}")
+
+    for table_name in tables:
+        invalidate_reference_ids(table_name)
+    bump_data_version()
+    progress.update({
+        "status": "done",
+        "finished_at": datetime.now(timezone.utc).isoformat(),
+        "rows": {t: sum(p["rows"] for p in progress["parts"] if p["table"] == t) for t in tables},
+    })
+    save()
+    record_throughput("restore", sum(progress["rows"].values()), time.perf_counter() - started)
+    return progress
+
+def restore_table_from_avro(table_name: str, point_in_time: datetime = None):
+    """
+    Restores data from the Avro backups into the specified database table.
+    The most recent full backup at or before point_in_time (latest if None)
+    is replayed together with its incremental backups.
+
+    Rows are streamed from S3 into a shadow copy of the table with its
+    secondary indexes dropped; the indexes are rebuilt once the load is done
+    and the shadow is atomically renamed over the live table, which stays
+    complete and readable throughout. Every part is checked against the
+    checksum in its manifest before the swap.
+    """
+    if table_name not in BACKUP_TABLES:
+        raise ValueError(f"Invalid table name: {table_name}")
+
+    expected = sum(
+        part["rows"]
+        for manifest in backup_chain(point_in_time)
+        for part in manifest["tables"].get(table_name, {}).get("parts", [])
+    )
+    if not expected:
+        raise RuntimeError(f"No data found in Avro backup for table {table_name}")
+
+    progress = restore_tables([table_name], point_in_time)
+    return f"Successfully restored {progress['rows'][table_name]} records into {table_name}"
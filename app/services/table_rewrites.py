@@ -0,0 +1,45 @@
+# services/table_rewrites.py
+from sqlalchemy import select
+
+from db import engine
+from models import TableRewrite
+
+# Ids looked up per query when checking whether an upsert overwrites rows.
+EXISTING_IDS_PER_QUERY = 1000
+
+rewrites_table = TableRewrite.__table__
+
+def create_rewrites_table():
+    rewrites_table.create(bind=engine, checkfirst=True)
+
+def record_rewrite(connection, table_name: str):
+    """
+    Counts a change to existing rows of table_name (an upsert overwriting
+    them, a replace or a restore) on the caller's transaction. Incremental
+    backups only pick up ids above their watermark, so the next backup
+    compares these counts and is taken in full if they moved.
+    """
+    updated = connection.execute(
+        rewrites_table.update()
+        .where(rewrites_table.c.table_name == table_name)
+        .values(rewrites=rewrites_table.c.rewrites + 1)
+    ).rowcount
+    if not updated:
+        connection.execute(rewrites_table.insert(), {"table_name": table_name, "rewrites": 1})
+
+def rewrite_counts(connection, tables):
+    """Returns the rewrite count of each table, 0 for tables never rewritten."""
+    counts = dict(connection.execute(
+        select(rewrites_table.c.table_name, rewrites_table.c.rewrites)
+        .where(rewrites_table.c.table_name.in_(list(tables)))
+    ).all())
+    return {table_name: counts.get(table_name, 0) for table_name in tables}
+
+def has_existing_ids(connection, table, ids):
+    """Whether any of ids is already a row of table (a SQLAlchemy Table with an id column)."""
+    ids = list(ids)
+    for start in range(0, len(ids), EXISTING_IDS_PER_QUERY):
+        query = select(table.c.id).where(table.c.id.in_(ids[start:start + EXISTING_IDS_PER_QUERY])).limit(1)
+        if connection.execute(query).first() is not None:
+            return True
+    return False
@@ -1,6 +1,19 @@
 # services/table_utils.py
-from sqlalchemy import inspect
+import os
+import threading
+import uuid
+from sqlalchemy import Column, MetaData, Table, bindparam, inspect, select, update
 from models import Base
+from services.table_rewrites import record_rewrite
+from services.validation import parse_hire_datetime
+
+# Rows read, parsed and updated per transaction while backfilling hired_at.
+HIRED_AT_BACKFILL_BATCH = int(os.getenv("HIRED_AT_BACKFILL_BATCH", "10000"))
+
+# Last result of check_required_tables once every table existed; None until
+# then or after invalidate_required_tables().
+_required_tables_ready = None
+_required_tables_lock = threading.Lock()
 
 def check_required_tables(engine):
     """
@@ -9,12 +22,156 @@ def check_required_tables(engine):
     """
     inspector = inspect(engine)
     existing_tables = inspector.get_table_names()
-    required_tables = {"hired_employees", "departments", "jobs"}
+    required_tables = {"hired_employees", "departments", "jobs", "hires_summary"}
     missing_tables = required_tables.difference(existing_tables)
     if missing_tables:
         return False, missing_tables
     return True, None
 
+def required_tables_status(engine, refresh: bool = False):
+    """
+    check_required_tables without the schema inspection on every call: once
+    all tables exist the result is kept until invalidate_required_tables()
+    (or refresh=True). An incomplete schema is checked again each time.
+    """
+    global _required_tables_ready
+    if _required_tables_ready is not None and not refresh:
+        return _required_tables_ready
+    with _required_tables_lock:
+        status = check_required_tables(engine)
+        _required_tables_ready = status if status[0] else None
+    return status
+
+def invalidate_required_tables():
+    """Forgets the cached schema check, e.g. after tables were created, renamed or dropped."""
+    global _required_tables_ready
+    _required_tables_ready = None
+
 def create_missing_tables(engine):
     """Creates all tables as defined in models.py."""
     Base.metadata.create_all(bind=engine)
+
+def ensure_hired_at_column(engine):
+    """
+    Adds the typed hired_at column and its composite index to a
+    hired_employees table created before they existed, backfilling hired_at
+    from the ISO datetime strings. The index is created after the backfill,
+    so a startup interrupted midway resumes it next time.
+    Returns True if hired_at was backfilled and hires_summary needs a rebuild.
+    """
+    index = next(i for i in Base.metadata.tables["hired_employees"].indexes if "hired_at" in i.columns)
+    inspector = inspect(engine)
+    columns = {c["name"] for c in inspector.get_columns("hired_employees")}
+    if "hired_at" in columns and index.name in {i["name"] for i in inspector.get_indexes("hired_employees")}:
+        return False
+    if "hired_at" not in columns:
+        with engine.begin() as connection:
+            connection.exec_driver_sql("ALTER TABLE hired_employees ADD COLUMN hired_at DATETIME NULL")
+    backfill_hired_at(engine)
+    index.create(bind=engine)
+    return True
+
+def backfill_hired_at(engine, batch_size: int = HIRED_AT_BACKFILL_BATCH):
+    """
+    Fills hired_at for rows that lack it, a batch of ids per transaction.
+    Values go through parse_hire_datetime like ingest and restore, so old and
+    new rows are converted to UTC and bucketed the same way; strings it
+    rejects are left NULL. Returns the number of rows filled.
+    """
+    table = Base.metadata.tables["hired_employees"]
+    fill = update(table).where(table.c.id == bindparam("row_id")).values(hired_at=bindparam("parsed"))
+    last_id = None
+    filled = 0
+    while True:
+        with engine.begin() as connection:
+            query = select(table.c.id, table.c.datetime).where(table.c.hired_at.is_(None))
+            if last_id is not None:
+                query = query.where(table.c.id > last_id)
+            rows = connection.execute(query.order_by(table.c.id).limit(batch_size)).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            values = []
+            for row_id, value in rows:
+                parsed = parse_hire_datetime(value) if value else None
+                if parsed is not None:
+                    values.append({"row_id": row_id, "parsed": parsed})
+            if values:
+                connection.execute(fill, values)
+            filled += len(values)
+    print(f"Backfilled hired_at for {filled} hired_employees rows")
+    return filled
+
+def shadow_table_name(table_name: str):
+    """
+    Returns a new shadow table name for one load of table_name. Every run gets
+    its own name, so concurrent replace ingests and restores of the same
+    table never load into or drop each other's shadow.
+    """
+    return f"{table_name}__shadow_{uuid.uuid4().hex[:12]}"
+
+def create_shadow_table(connection, table_name: str):
+    """
+    Creates an empty copy of table_name to be loaded and swapped in later.
+    Returns its name.
+    """
+    shadow = shadow_table_name(table_name)
+    if connection.dialect.name == "mysql":
+        connection.exec_driver_sql(f"CREATE TABLE `{shadow}` LIKE `{table_name}`")
+    else:
+        columns = [
+            Column(c.name, c.type, primary_key=c.primary_key, nullable=c.nullable)
+            for c in Base.metadata.tables[table_name].columns
+        ]
+        Table(shadow, MetaData(), *columns).create(bind=connection)
+    return shadow
+
+def drop_shadow_table(connection, shadow: str):
+    """Drops a shadow table returned by create_shadow_table if it exists."""
+    connection.exec_driver_sql(f"DROP TABLE IF EXISTS {shadow}")
+
+def swap_shadow_table(connection, table_name: str, shadow: str):
+    """
+    Replaces table_name with the shadow table shadow.
+    On MySQL both renames happen in a single atomic RENAME TABLE. Other
+    databases (SQLite in development) copy the rows over inside the caller's
+    transaction instead, which keeps the live table's index names intact.
+    The swap is recorded with record_rewrite, so the next incremental backup
+    is taken in full.
+    """
+    if connection.dialect.name == "mysql":
+        old = f"{shadow}_old"
+        connection.exec_driver_sql(f"RENAME TABLE `{table_name}` TO `{old}`, `{shadow}` TO `{table_name}`")
+        connection.exec_driver_sql(f"DROP TABLE `{old}`")
+    else:
+        connection.exec_driver_sql(f"DELETE FROM {table_name}")
+        connection.exec_driver_sql(f"INSERT INTO {table_name} SELECT * FROM {shadow}")
+        connection.exec_driver_sql(f"DROP TABLE {shadow}")
+    record_rewrite(connection, table_name)
+    invalidate_required_tables()
+
+def drop_secondary_indexes(connection, table_name: str):
+    """
+    Drops every non-primary index of table_name so a bulk load does not
+    maintain them row by row. Returns the dropped index definitions for
+    create_indexes. Only MySQL shadow tables carry copied indexes; elsewhere
+    nothing is dropped.
+    """
+    if connection.dialect.name != "mysql":
+        return []
+    indexes = inspect(connection).get_indexes(table_name)
+    if indexes:
+        drops = ", ".join(f"DROP INDEX `{index['name']}`" for index in indexes)
+        connection.exec_driver_sql(f"ALTER TABLE `{table_name}` {drops}")
+    return indexes
+
+def create_indexes(connection, table_name: str, indexes):
+    """Recreates indexes returned by drop_secondary_indexes in a single ALTER TABLE."""
+    if not indexes:
+        return
+    adds = ", ".join(
+        f"ADD {'UNIQUE ' if index['unique'] else ''}INDEX `{index['name']}` "
+        f"({', '.join(f'`{c}`' for c in index['column_names'])})"
+        for index in indexes
+    )
+    connection.exec_driver_sql(f"ALTER TABLE `{table_name}` {adds}")
@@ -0,0 +1,270 @@
+# services/validation.py
+import csv
+import io
+import time
+from datetime import datetime, timezone
+from typing import NamedTuple, Optional
+
+import numpy as np
+from sqlalchemy import Integer
+
+# Column kinds understood by the batch validator.
+INT = "int"
+STRING = "string"
+ISO_DATETIME = "iso_datetime"
+
+# Longest decimal string that always fits in an int64.
+_MAX_FAST_INT_DIGITS = 18
+_INT64_MIN, _INT64_MAX = np.iinfo(np.int64).min, np.iinfo(np.int64).max
+
+
+class ColumnSpec(NamedTuple):
+    name: str
+    kind: str
+    target: Optional[str] = None  # extra column that receives the parsed value
+
+
+class BatchValidation(NamedTuple):
+    valid: np.ndarray    # bool mask, one entry per input row
+    reasons: np.ndarray  # error reason per row, None where the row is valid
+    columns: dict        # column name -> values to store, aligned with the input rows
+    datetimes: dict      # datetime column name -> parsed datetime objects
+    rows: list           # the raw input rows
+    stripped: dict       # row index -> stripped fields, for invalid rows with the right field count
+
+
+def build_column_specs(config: dict):
+    """
+    Derives the column specs for a FILE_CONFIG entry.
+    Kinds come from the model's column types unless overridden in config["formats"].
+    config["parsed_columns"] maps a datetime field to the typed column that
+    stores its parsed value.
+    """
+    model = config["model"]
+    formats = config.get("formats", {})
+    parsed_columns = config.get("parsed_columns", {})
+    specs = []
+    for name in config["fields"]:
+        if name in formats:
+            kind = formats[name]
+        elif isinstance(model.__table__.columns[name].type, Integer):
+            kind = INT
+        else:
+            kind = STRING
+        specs.append(ColumnSpec(name, kind, parsed_columns.get(name)))
+    return specs
+
+
+def insert_columns(specs):
+    """Returns the table columns of the tuples produced by valid_rows."""
+    return [spec.name for spec in specs] + [spec.target for spec in specs if spec.target]
+
+
+def _parse_iso_datetime(value: str):
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+
+_parse_iso_datetime_column = np.frompyfunc(_parse_iso_datetime, 1, 1)
+
+
+def _to_naive_utc(value: datetime):
+    return value.astimezone(timezone.utc).replace(tzinfo=None) if value.tzinfo else value
+
+
+def parse_hire_datetime(value: str):
+    """
+    Parses an ISO-8601 string into a naive UTC datetime, the form stored in
+    typed DATETIME columns. Returns None if the value is not valid.
+    """
+    parsed = _parse_iso_datetime(value)
+    return _to_naive_utc(parsed) if parsed is not None else None
+
+
+def _stripped_column(rows, ok_idx: np.ndarray, col: int):
+    """
+    Returns field col of the rows at ok_idx, stripped, as an object array.
+    Unlike a fixed-width unicode array this takes no more memory than the
+    strings themselves, however long the longest one is, and keeps every
+    character, trailing NULs included.
+    """
+    values = np.empty(ok_idx.size, dtype=object)
+    values[:] = [rows[i][col].strip() for i in ok_idx]
+    return values
+
+
+def _int_column(values: np.ndarray, live: np.ndarray):
+    """
+    Parses a column of stripped strings as integers.
+    Plain digit strings are converted in bulk; anything else goes through int()
+    so accepted values and error messages match the per-row validator.
+    Returns (parsed, failed, reasons).
+    """
+    parsed = np.zeros(len(values), dtype=object)
+    failed = np.zeros(len(values), dtype=bool)
+    reasons = {}
+
+    short_digits = np.fromiter(
+        (value.isdecimal() and len(value) <= _MAX_FAST_INT_DIGITS for value in values), dtype=bool, count=len(values)
+    )
+    fast = live & short_digits
+    if fast.any():
+        parsed[fast] = values[fast].astype(np.int64).astype(object)
+
+    for i in np.flatnonzero(live & ~fast):
+        try:
+            parsed[i] = int(str(values[i]))
+        except ValueError as e:
+            failed[i] = True
+            reasons[i] = str(e)
+    return parsed, failed, reasons
+
+
+def _iso_datetime_column(values: np.ndarray, live: np.ndarray):
+    """Parses a column of ISO-8601 strings. Returns (parsed, failed, reasons)."""
+    parsed = np.full(len(values), None, dtype=object)
+    if live.any():
+        parsed[live] = _parse_iso_datetime_column(values[live])
+    failed = live & np.equal(parsed, None)
+    reasons = {i: f"Invalid datetime format: {values[i]}" for i in np.flatnonzero(failed)}
+    return parsed, failed, reasons
+
+
+def _known_ids(ids: np.ndarray, allowed: np.ndarray):
+    """Returns which of the Python ints in ids are in the sorted array allowed."""
+    try:
+        return np.isin(ids.astype(np.int64), allowed, assume_unique=True)
+    except OverflowError:
+        # Ids outside int64 cannot be stored, so they are never known.
+        fits = np.fromiter((_INT64_MIN <= i <= _INT64_MAX for i in ids), dtype=bool, count=len(ids))
+        known = np.zeros(len(ids), dtype=bool)
+        known[fits] = np.isin(ids[fits].astype(np.int64), allowed, assume_unique=True)
+        return known
+
+
+def _reference_column(parsed: np.ndarray, live: np.ndarray, allowed: np.ndarray, name: str):
+    """Flags parsed ids that are missing from the sorted array allowed. Returns (failed, reasons)."""
+    failed = np.zeros(len(parsed), dtype=bool)
+    if live.any():
+        failed[live] = ~_known_ids(parsed[live], allowed)
+    reasons = {i: f"Unknown {name}: {parsed[i]}" for i in np.flatnonzero(failed)}
+    return failed, reasons
+
+
+def validate_batch(specs, rows, references: dict = None):
+    """
+    Validates a batch of raw CSV rows column by column.
+    Checks run in the same order as the per-row validator (field count, empty
+    fields, then each column in file order), so each invalid row reports the
+    same first error it always did.
+    references maps integer columns to the sorted ids they may hold; values
+    not found there fail right after the column parses.
+    """
+    references = references or {}
+    n = len(rows)
+    width = len(specs)
+    reasons = np.full(n, None, dtype=object)
+    columns = {spec.name: np.full(n, None, dtype=object) for spec in specs}
+    datetimes = {spec.name: np.full(n, None, dtype=object) for spec in specs if spec.kind == ISO_DATETIME}
+    stripped = {}
+
+    lengths = np.fromiter(map(len, rows), dtype=np.int64, count=n)
+    wrong_width = lengths != width
+    for i in np.flatnonzero(wrong_width):
+        reasons[i] = f"Expected {width} fields, got {lengths[i]}"
+
+    ok_idx = np.flatnonzero(~wrong_width)
+    if ok_idx.size:
+        fields = [_stripped_column(rows, ok_idx, col) for col in range(width)]
+
+        empty = np.zeros(ok_idx.size, dtype=bool)
+        for values in fields:
+            empty |= values == ""
+        reasons[ok_idx[empty]] = "One or more fields are empty"
+        live = ~empty
+
+        for spec, values in zip(specs, fields):
+            if spec.kind == INT:
+                parsed, failed, col_reasons = _int_column(values, live)
+            elif spec.kind == ISO_DATETIME:
+                # The raw string is stored; the parsed value is kept alongside it.
+                parsed_datetimes, failed, col_reasons = _iso_datetime_column(values, live)
+                datetimes[spec.name][ok_idx] = parsed_datetimes
+                parsed = values
+            else:
+                parsed, failed, col_reasons = values, np.zeros(len(values), dtype=bool), {}
+
+            for i, reason in col_reasons.items():
+                reasons[ok_idx[i]] = reason
+            live &= ~failed
+
+            if spec.name in references:
+                failed, col_reasons = _reference_column(parsed, live, references[spec.name], spec.name)
+                for i, reason in col_reasons.items():
+                    reasons[ok_idx[i]] = reason
+                live &= ~failed
+            columns[spec.name][ok_idx] = parsed
+
+    valid = np.equal(reasons, None)
+    if ok_idx.size:
+        for j in np.flatnonzero(~valid[ok_idx]).tolist():
+            stripped[int(ok_idx[j])] = [values[j] for values in fields]
+    return BatchValidation(valid, reasons, columns, datetimes, rows, stripped)
+
+
+def valid_rows(specs, result: BatchValidation):
+    """
+    Returns the valid rows of a validated batch as tuples in insert_columns
+    order: the file's fields followed by the typed datetime columns.
+    """
+    columns = [result.columns[spec.name][result.valid].tolist() for spec in specs]
+    for spec in specs:
+        if spec.target:
+            columns.append([_to_naive_utc(value) for value in result.datetimes[spec.name][result.valid].tolist()])
+    return list(zip(*columns))
+
+
+def error_details(result: BatchValidation):
+    """
+    Returns (row index, fields, reason) for each invalid row of a batch.
+    Fields are stripped unless the field count was wrong.
+    """
+    return [
+        (i, list(result.stripped.get(i, result.rows[i])), result.reasons[i])
+        for i in np.flatnonzero(~result.valid).tolist()
+    ]
+
+
+def error_rows(errors, first_row_number: int = 1):
+    """
+    Builds error file rows from error_details: the row's fields followed by
+    "Row <n>: <reason>", numbering the batch from first_row_number.
+    """
+    return [fields + [f"Row {first_row_number + i}: {reason}"] for i, fields, reason in errors]
+
+
+def parse_csv_text(text: str, field_size_limit: int = None):
+    """
+    Parses a block of complete CSV records into a list of rows.
+    field_size_limit raises csv's per-field limit (131072 characters by
+    default) for this process.
+    """
+    if field_size_limit and csv.field_size_limit() < field_size_limit:
+        csv.field_size_limit(field_size_limit)
+    return list(csv.reader(io.StringIO(text, newline="")))
+
+
+def parse_and_validate(specs, text: str, references: dict = None, field_size_limit: int = None):
+    """
+    Parses and validates a block of complete CSV records.
+    Runs in the ingest process pool, so it only takes and returns picklable
+    values: (row count, valid row tuples, error details, (parse seconds,
+    validate seconds)).
+    """
+    start = time.perf_counter()
+    rows = parse_csv_text(text, field_size_limit)
+    parsed = time.perf_counter()
+    result = validate_batch(specs, rows, references)
+    valid, errors = valid_rows(specs, result), error_details(result)
+    return len(rows), valid, errors, (parsed - start, time.perf_counter() - parsed)
@@ -0,0 +1,118 @@
+# benchmarks/datagen.py
+"""
+Generates hired_employees/departments/jobs CSV files of any size that look
+like the samples under data/.
+
+departments.csv and jobs.csv are copied from the samples (they are lookup
+tables and do not grow). hired_employees.csv is drawn from the samples'
+empirical distributions: first and last names, department and job id
+frequencies (missing ids included), hire times spread over the sampled
+time range, and the per-column rate of empty fields, so the share of rows
+rejected by validation matches the sample.
+
+Usage:
+    python benchmarks/datagen.py --rows 1000000 --out /tmp/bench-data
+"""
+import argparse
+import csv
+import os
+import shutil
+from collections import Counter
+from datetime import datetime, timezone
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_DIR = os.path.join(ROOT, "data")
+LOOKUP_FILES = ("departments.csv", "jobs.csv")
+# Rows generated and written per chunk, to keep memory flat at any size.
+CHUNK_ROWS = 500_000
+
+
+def _timestamp(value: str):
+    return int(datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp())
+
+
+def _distribution(values):
+    counts = Counter(values)
+    keys = sorted(counts)
+    weights = np.array([counts[k] for k in keys], dtype=float)
+    return np.array(keys, dtype=object), weights / weights.sum()
+
+
+def load_profile(sample_dir: str = SAMPLE_DIR):
+    """Reads the sample hired_employees.csv and returns the distributions generate() draws from."""
+    with open(os.path.join(sample_dir, "hired_employees.csv"), newline="") as sample:
+        rows = [row for row in csv.reader(sample) if len(row) == 5]
+    names = [row[1].split(" ", 1) for row in rows if row[1].strip()]
+    times = [_timestamp(row[2]) for row in rows if row[2].strip()]
+    return {
+        "first_names": np.array(sorted({n[0] for n in names}), dtype=object),
+        "last_names": np.array(sorted({n[1] for n in names if len(n) == 2}), dtype=object),
+        "departments": _distribution(row[3].strip() for row in rows),
+        "jobs": _distribution(row[4].strip() for row in rows),
+        "time_range": (min(times), max(times)),
+        # Share of rows with an empty name or datetime; empty ids are part of
+        # the department and job distributions, and the id is never empty.
+        "empty_rates": [0.0] + [sum(1 for row in rows if not row[i].strip()) / len(rows) for i in (1, 2)] + [0.0, 0.0],
+    }
+
+
+def generate_chunk(rng, profile: dict, first_id: int, count: int):
+    """Returns count hired_employees rows with ids from first_id."""
+    ids = np.arange(first_id, first_id + count)
+    names = (
+        rng.choice(profile["first_names"], count).astype(str).astype(object)
+        + " "
+        + rng.choice(profile["last_names"], count).astype(str).astype(object)
+    )
+    start, end = profile["time_range"]
+    seconds = rng.integers(start, end + 1, count)
+    times = np.datetime_as_string(seconds.astype("datetime64[s]"), unit="s").astype(object) + "Z"
+    department_keys, department_weights = profile["departments"]
+    job_keys, job_weights = profile["jobs"]
+    departments = rng.choice(department_keys, count, p=department_weights)
+    jobs = rng.choice(job_keys, count, p=job_weights)
+
+    columns = [ids.astype(object), names, times, departments, jobs]
+    for i, rate in enumerate(profile["empty_rates"]):
+        if rate:
+            columns[i][rng.random(count) < rate] = ""
+    return zip(*columns)
+
+
+def generate(out_dir: str, rows: int, seed: int = 42, sample_dir: str = SAMPLE_DIR):
+    """
+    Writes departments.csv, jobs.csv and a hired_employees.csv of rows rows
+    into out_dir. The same seed always produces the same files.
+    Returns the path of each file.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    paths = {}
+    for file_name in LOOKUP_FILES:
+        paths[file_name] = shutil.copyfile(os.path.join(sample_dir, file_name), os.path.join(out_dir, file_name))
+
+    profile = load_profile(sample_dir)
+    rng = np.random.default_rng(seed)
+    path = os.path.join(out_dir, "hired_employees.csv")
+    with open(path, "w", newline="") as out:
+        writer = csv.writer(out, lineterminator="\n")
+        for first_id in range(1, rows + 1, CHUNK_ROWS):
+            writer.writerows(generate_chunk(rng, profile, first_id, min(CHUNK_ROWS, rows + 1 - first_id)))
+    paths["hired_employees.csv"] = path
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10_000, help="hired_employees rows to generate (10k to 50M)")
+    parser.add_argument("--out", required=True, help="output directory")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    started = datetime.now(timezone.utc)
+    paths = generate(args.out, args.rows, args.seed)
+    print(f"Wrote {args.rows} rows to {paths['hired_employees.csv']} in {(datetime.now(timezone.utc) - started).total_seconds():.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,352 @@
+# benchmarks/run_benchmarks.py
+"""
+Benchmarks the ingest, report, backup and restore pipelines end to end.
+
+The real service functions run against a SQLite file (default) or any
+database given with --database-url, with S3 served in-process by moto
+unless --s3 real is passed (boto3 then uses the usual AWS settings, e.g.
+AWS_ENDPOINT_URL for a local S3 stand-in). Data comes from datagen.py.
+Install the extra benchmark dependencies with
+pip install -r benchmarks/requirements.txt.
+
+For each scenario the harness reports throughput (rows/s, median of the
+runs), latency percentiles over the runs and the peak RSS of this process
+while the scenario ran (validation workers are separate processes and are
+not included). Results can be saved as a baseline and later runs compared
+against it; a throughput drop or p95 latency rise beyond --tolerance is
+reported as a regression and the exit status is 1.
+
+Usage:
+    python benchmarks/run_benchmarks.py --rows 100000 --output results.json
+    python benchmarks/run_benchmarks.py --rows 100000 --baseline benchmarks/baseline.json --save-baseline
+    python benchmarks/run_benchmarks.py --rows 100000 --baseline benchmarks/baseline.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+APP_DIR = os.path.join(ROOT, "app")
+sys.path.insert(0, BENCH_DIR)
+
+import datagen  # noqa: E402
+
+SCENARIOS = ("ingest", "reports", "backup", "restore")
+RAW_BUCKET = "bench-raw"
+BACKUP_BUCKET = "bench-backup"
+
+
+class RssSampler:
+    """Samples this process's resident set size in a background thread and keeps the peak."""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+    def _rss(self):
+        try:
+            with open("/proc/self/statm") as statm:
+                return int(statm.read().split()[1]) * self._page_size
+        except OSError:
+            # No /proc (macOS): fall back to the lifetime peak (bytes there, KiB on Linux).
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self._rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = self._rss()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self._rss())
+        return False
+
+
+def summarize(name: str, durations, rows: int, peak_rss: int):
+    """Builds a scenario result from the duration of each run and the rows each run handled."""
+    durations = np.array(durations)
+    throughputs = rows / durations if rows else np.zeros_like(durations)
+    return {
+        "scenario": name,
+        "runs": len(durations),
+        "rows": rows,
+        "throughput_rows_per_s": float(np.median(throughputs)),
+        "latency_s": {
+            "mean": float(durations.mean()),
+            "min": float(durations.min()),
+            "p50": float(np.percentile(durations, 50)),
+            "p95": float(np.percentile(durations, 95)),
+            "p99": float(np.percentile(durations, 99)),
+            "max": float(durations.max()),
+        },
+        "peak_rss_mb": round(peak_rss / (1024 * 1024), 1),
+    }
+
+
+def configure_environment(args, work_dir: str):
+    """Points the app at the benchmark database and buckets; must run before the app is imported."""
+    os.environ["DATABASE_URL"] = args.database_url or f"sqlite:///{os.path.join(work_dir, 'bench.db')}"
+    os.environ["S3_BUCKET"] = RAW_BUCKET
+    os.environ["S3_BACKUP_BUCKET"] = BACKUP_BUCKET
+    if args.s3 == "moto":
+        for key, value in (("AWS_ACCESS_KEY_ID", "bench"), ("AWS_SECRET_ACCESS_KEY", "bench"), ("AWS_DEFAULT_REGION", "us-east-1")):
+            os.environ[key] = value
+        try:
+            from moto import mock_aws
+        except ImportError:
+            raise SystemExit(
+                "--s3 moto needs the moto package: pip install -r benchmarks/requirements.txt "
+                "(or pass --s3 real to use AWS or an S3-compatible endpoint)"
+            )
+        mock = mock_aws()
+        mock.start()
+        import boto3
+        s3 = boto3.client("s3")
+        for bucket in (RAW_BUCKET, BACKUP_BUCKET):
+            s3.create_bucket(Bucket=bucket)
+        return mock
+    return None
+
+
+def reset_database():
+    from db import engine
+    from models import Base
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+
+
+def ingest_file(path: str, stream: bool = True):
+    from starlette.datastructures import UploadFile
+    from services.csv_processor import process_upload
+    with open(path, "rb") as data:
+        return asyncio.run(process_upload(UploadFile(data, filename=os.path.basename(path)), stream=stream))
+
+
+def load_lookups(paths: dict):
+    for file_name in datagen.LOOKUP_FILES:
+        ingest_file(paths[file_name])
+
+
+def bench_ingest(paths: dict, repeat: int):
+    """Streams hired_employees.csv through the upload pipeline into an empty table, repeat times."""
+    durations = []
+    result = None
+    with RssSampler() as rss:
+        for _ in range(repeat):
+            reset_database()
+            load_lookups(paths)
+            started = time.perf_counter()
+            result = ingest_file(paths["hired_employees.csv"])
+            durations.append(time.perf_counter() - started)
+    rows = result["inserted_rows"] + result["error_rows"]
+    return [summarize("ingest", durations, rows, rss.peak)]
+
+
+def bench_reports(repeat: int):
+    """Runs both report queries repeat times each on the loaded data."""
+    from db import SessionLocal
+    from services import query1, query2
+    results = []
+    for name, fetch in (
+        ("report_hired_per_quarter", query1.fetch_hired_employees_per_quarter),
+        ("report_departments_above_mean", query2.fetch_departments_above_mean_hires),
+    ):
+        durations = []
+        with RssSampler() as rss, SessionLocal() as db:
+            for _ in range(repeat):
+                started = time.perf_counter()
+                rows = len(fetch(db, 2021))
+                durations.append(time.perf_counter() - started)
+        results.append(summarize(name, durations, rows, rss.peak))
+    return results
+
+
+def bench_backup(repeat: int):
+    """Takes repeat full backups of all tables."""
+    from services.backup_service import backup_all_tables
+    durations = []
+    with RssSampler() as rss:
+        for _ in range(repeat):
+            started = time.perf_counter()
+            manifest = backup_all_tables()
+            durations.append(time.perf_counter() - started)
+    rows = sum(table["rows"] for table in manifest["tables"].values())
+    return [summarize("backup", durations, rows, rss.peak)]
+
+
+def bench_restore(repeat: int):
+    """Restores all tables from the latest backup, repeat times."""
+    from services.restore_service import restore_tables
+    durations = []
+    with RssSampler() as rss:
+        for _ in range(repeat):
+            started = time.perf_counter()
+            progress = restore_tables()
+            durations.append(time.perf_counter() - started)
+    return [summarize("restore", durations, sum(progress["rows"].values()), rss.peak)]
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results: dict, baseline: dict, tolerance: float):
+    """
+    Compares each scenario with the baseline. Returns the regressions found:
+    throughput below (1 - tolerance) x baseline or p95 latency above
+    (1 + tolerance) x baseline.
+    """
+    if results["meta"]["rows"] != baseline["meta"]["rows"] or results["meta"]["database"] != baseline["meta"]["database"]:
+        print("Warning: baseline was recorded with a different row count or database; comparison is indicative only.")
+    regressions = []
+    print(f"\n{'scenario':32} {'rows/s':>12} {'baseline':>12} {'change':>8} {'p95 s':>9} {'baseline':>9} {'change':>8}")
+    for name, current in results["scenarios"].items():
+        previous = baseline["scenarios"].get(name)
+        if previous is None:
+            print(f"{name:32} (not in baseline)")
+            continue
+        throughput_change = current["throughput_rows_per_s"] / previous["throughput_rows_per_s"] - 1 if previous["throughput_rows_per_s"] else 0.0
+        p95_change = current["latency_s"]["p95"] / previous["latency_s"]["p95"] - 1 if previous["latency_s"]["p95"] else 0.0
+        flags = []
+        if throughput_change < -tolerance:
+            flags.append("throughput")
+        if p95_change > tolerance:
+            flags.append("p95 latency")
+        print(
+            f"{name:32} {current['throughput_rows_per_s']:>12.0f} {previous['throughput_rows_per_s']:>12.0f} {throughput_change:>+8.1%}"
+            f" {current['latency_s']['p95']:>9.3f} {previous['latency_s']['p95']:>9.3f} {p95_change:>+8.1%}"
+            + (f"  REGRESSION ({', '.join(flags)})" if flags else "")
+        )
+        if flags:
+            regressions.append({"scenario": name, "metrics": flags})
+    return regressions
+
+
+def print_results(results: dict):
+    print(f"\n{'scenario':32} {'runs':>4} {'rows':>10} {'rows/s':>12} {'p50 s':>9} {'p95 s':>9} {'p99 s':>9} {'peak RSS MB':>12}")
+    for name, result in results["scenarios"].items():
+        latency = result["latency_s"]
+        print(
+            f"{name:32} {result['runs']:>4} {result['rows']:>10} {result['throughput_rows_per_s']:>12.0f}"
+            f" {latency['p50']:>9.3f} {latency['p95']:>9.3f} {latency['p99']:>9.3f} {result['peak_rss_mb']:>12.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10_000, help="hired_employees rows (10k to 50M)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--data-dir", help="reuse (or create) generated data in this directory")
+    parser.add_argument("--database-url", help="SQLAlchemy URL of a scratch database; its tables are dropped (default: a SQLite file)")
+    parser.add_argument("--s3", choices=("moto", "real"), default="moto")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma-separated subset of " + ", ".join(SCENARIOS))
+    parser.add_argument("--repeat", type=int, default=3, help="runs per ingest/backup/restore scenario")
+    parser.add_argument("--query-repeat", type=int, default=20, help="runs per report query")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="baseline JSON to compare against (or to write with --save-baseline)")
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed relative regression (default 0.15)")
+    args = parser.parse_args()
+
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    work_dir = tempfile.mkdtemp(prefix="bench-")
+    mock = configure_environment(args, work_dir)
+    sys.path.insert(0, APP_DIR)
+    from db import engine
+    from services.executors import shutdown_executors
+
+    data_dir = args.data_dir or os.path.join(work_dir, "data")
+    paths = {name: os.path.join(data_dir, name) for name in datagen.LOOKUP_FILES + ("hired_employees.csv",)}
+    if not all(os.path.exists(path) for path in paths.values()):
+        print(f"Generating {args.rows} rows in {data_dir}...")
+        paths = datagen.generate(data_dir, args.rows, args.seed)
+
+    results = {
+        "meta": {
+            "rows": args.rows,
+            "seed": args.seed,
+            "database": engine.dialect.name,
+            "s3": args.s3,
+            "repeat": args.repeat,
+            "query_repeat": args.query_repeat,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "git_revision": git_revision(),
+            "created_at": datetime.now(timezone.utc).isoformat(),
+        },
+        "scenarios": {},
+    }
+    try:
+        # Reports, backup and restore all need the data loaded once.
+        if "ingest" in scenarios:
+            for result in bench_ingest(paths, args.repeat):
+                results["scenarios"][result["scenario"]] = result
+        elif set(scenarios) & {"reports", "backup", "restore"}:
+            reset_database()
+            load_lookups(paths)
+            ingest_file(paths["hired_employees.csv"])
+        if "reports" in scenarios:
+            for result in bench_reports(args.query_repeat):
+                results["scenarios"][result["scenario"]] = result
+        if "backup" in scenarios or "restore" in scenarios:
+            backup_results = bench_backup(args.repeat if "backup" in scenarios else 1)
+            if "backup" in scenarios:
+                for result in backup_results:
+                    results["scenarios"][result["scenario"]] = result
+        if "restore" in scenarios:
+            for result in bench_restore(args.repeat):
+                results["scenarios"][result["scenario"]] = result
+    finally:
+        shutdown_executors()
+        if mock is not None:
+            mock.stop()
+
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as out:
+            json.dump(results, out, indent=2)
+
+    regressions = []
+    if args.baseline and args.save_baseline:
+        with open(args.baseline, "w") as out:
+            json.dump(results, out, indent=2)
+        print(f"\nBaseline saved to {args.baseline}")
+    elif args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        print(f"\n{len(regressions)} regression(s) beyond {args.tolerance:.0%}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
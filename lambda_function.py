@@ -1,56 +1,208 @@
 import json
 import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import boto3
 
 # Environment Variables (Set these in AWS Lambda)
 API_URL = os.getenv("API_URL")  # Example: http://your-ec2-instance/api/upload_csv
 S3_BUCKET_NAME = os.getenv("S3_BUCKET_NAME")  # Example: "your-raw-data-bucket"
 
+# Rows per API request (the API accepts up to 1,000 rows per request).
+BATCH_ROWS = int(os.getenv("BATCH_ROWS", "1000"))
+# Batches posted at the same time.
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", "4"))
+# Retries per batch on connection errors and 429/5xx responses, with exponential backoff.
+MAX_RETRIES = int(os.getenv("MAX_RETRIES", "5"))
+BACKOFF_FACTOR = float(os.getenv("BACKOFF_FACTOR", "0.5"))
+REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", "60"))
+# Bytes read from S3 at a time.
+READ_CHUNK_SIZE = int(os.getenv("READ_CHUNK_SIZE", str(1024 * 1024)))
+# Longest CSV record accepted; a longer one usually means an unbalanced quote.
+MAX_RECORD_BYTES = int(os.getenv("MAX_RECORD_BYTES", str(4 * 1024 * 1024)))
+
+# Prefixes the loaded files are moved to; objects under them are never loaded.
+PROCESSED_PREFIX = "processed/"
+ERRORS_PREFIX = "errors/"
+
 s3_client = boto3.client("s3")
 
+def create_session():
+    """
+    Returns a requests session that keeps up to MAX_CONCURRENCY connections
+    to the API alive and retries failed batches with backoff. POSTs are
+    retried too: every batch carries its own Idempotency-Key, and the API
+    answers a repeated key with the stored response instead of loading the
+    batch (and writing its error file) again. A repeat that arrives while the
+    first attempt is still running gets a 409 and is retried after a backoff.
+    """
+    retry = Retry(
+        total=MAX_RETRIES,
+        backoff_factor=BACKOFF_FACTOR,
+        status_forcelist=(409, 429, 500, 502, 503, 504),
+        allowed_methods=frozenset(["POST"]),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MAX_CONCURRENCY, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+session = create_session()
+
+def in_quoted_field(line, in_quotes=False):
+    """
+    Returns whether a quoted field is still open at the end of line, given
+    whether one was open at its start. Quotes follow csv.reader: a '"' opens
+    a quoted field only at the start of a field, '""' inside one is an
+    escaped quote, and any other '"' is literal text.
+    """
+    pos = 0
+    while True:
+        quote = line.find(b'"', pos)
+        if quote < 0:
+            return in_quotes
+        if in_quotes:
+            if line[quote + 1:quote + 2] == b'"':
+                pos = quote + 2
+                continue
+            in_quotes = False
+        elif quote == 0 or line[quote - 1] in b",\r\n":
+            in_quotes = True
+        pos = quote + 1
+
+def iter_batches(body, batch_rows=BATCH_ROWS):
+    """
+    Reads the S3 object body as a stream and yields (first row number, batch)
+    pairs, each batch holding the bytes of up to batch_rows complete CSV
+    records. A line ending inside a quoted field does not end a record.
+    Raises ValueError if a record grows past MAX_RECORD_BYTES.
+    """
+    batch = []
+    record = []
+    record_bytes = 0
+    quoted = False
+    first_row = 1
+    for line in body.iter_lines(chunk_size=READ_CHUNK_SIZE, keepends=True):
+        record.append(line)
+        record_bytes += len(line)
+        quoted = in_quoted_field(line, quoted)
+        if quoted:
+            if record_bytes > MAX_RECORD_BYTES:
+                raise ValueError(f"CSV record at row {first_row + len(batch)} is longer than {MAX_RECORD_BYTES} bytes; check for an unbalanced quote")
+            continue
+        batch.append(b"".join(record))
+        record = []
+        record_bytes = 0
+        if len(batch) >= batch_rows:
+            yield first_row, b"".join(batch)
+            first_row += len(batch)
+            batch = []
+    if record:
+        batch.append(b"".join(record))
+    if batch:
+        yield first_row, b"".join(batch)
+
+def post_batch(file_name, first_row, data, idempotency_key):
+    """Posts one batch to the API, raising if it still fails after the retries."""
+    files = {"file": (file_name, data, "text/csv")}
+    response = session.post(
+        API_URL,
+        params={"mode": "upsert", "first_row": first_row},
+        files=files,
+        headers={"Idempotency-Key": idempotency_key},
+        timeout=REQUEST_TIMEOUT,
+    )
+    if response.status_code != 200:
+        raise RuntimeError(f"API responded with {response.status_code}: {response.text}")
+    return response.json()
+
+def load_object(s3_bucket, s3_key):
+    """
+    Streams an S3 object to the API in batches of BATCH_ROWS rows, keeping
+    up to MAX_CONCURRENCY batches in flight.
+    Returns the totals reported by the API, or raises on the first failed batch.
+    """
+    file_name = os.path.basename(s3_key)
+    body = s3_client.get_object(Bucket=s3_bucket, Key=s3_key)["Body"]
+    # Keys are stable per object version, so a re-delivered event reuses them.
+    etag = s3_client.head_object(Bucket=s3_bucket, Key=s3_key)["ETag"].strip('"')
+    totals = {"batches": 0, "inserted_rows": 0, "error_rows": 0, "error_files": []}
+
+    def collect(done):
+        for future in done:
+            result = future.result()
+            totals["batches"] += 1
+            totals["inserted_rows"] += result.get("inserted_rows", 0)
+            totals["error_rows"] += result.get("error_rows", 0)
+            if result.get("error_file"):
+                totals["error_files"].append(result["error_file"])
+
+    in_flight = set()
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENCY) as pool:
+        try:
+            for first_row, data in iter_batches(body):
+                if len(in_flight) >= MAX_CONCURRENCY:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    collect(done)
+                key = str(uuid.uuid5(uuid.NAMESPACE_URL, f"s3://{s3_bucket}/{s3_key}?etag={etag}&row={first_row}"))
+                in_flight.add(pool.submit(post_batch, file_name, first_row, data, key))
+            collect(wait(in_flight).done)
+        except Exception:
+            for future in in_flight:
+                future.cancel()
+            raise
+    return totals
+
+def move_object(s3_bucket, s3_key, prefix):
+    """Moves an object to prefix, keeping its file name."""
+    target = prefix + os.path.basename(s3_key)
+    s3_client.copy_object(Bucket=s3_bucket, Key=target, CopySource={"Bucket": s3_bucket, "Key": s3_key})
+    s3_client.delete_object(Bucket=s3_bucket, Key=s3_key)
+    return target
+
 def lambda_handler(event, context):
     """
     AWS Lambda function triggered by S3 when a new CSV file is uploaded.
-    Downloads the file and sends it to the API's /upload_csv endpoint.
+    Streams the file to the API's /upload_csv endpoint in row batches, then
+    moves it to processed/ or, if a batch could not be loaded, to errors/.
     """
-    try:
-        # Extract S3 file details from the event
-        for record in event["Records"]:
-            s3_bucket = record["s3"]["bucket"]["name"]
-            s3_key = record["s3"]["object"]["key"]
+    results = []
+    failed = False
+    for record in event["Records"]:
+        s3_bucket = record["s3"]["bucket"]["name"]
+        s3_key = record["s3"]["object"]["key"]
 
-            print(f"New file detected: {s3_key} in bucket: {s3_bucket}")
+        print(f"New file detected: {s3_key} in bucket: {s3_bucket}")
 
-            # Validate the file type (only process CSV files)
-            if not s3_key.endswith(".csv"):
-                print(f"Skipping non-CSV file: {s3_key}")
-                continue
+        # Validate the file type (only process CSV files)
+        if not s3_key.endswith(".csv"):
+            print(f"Skipping non-CSV file: {s3_key}")
+            continue
+        if s3_key.startswith((PROCESSED_PREFIX, ERRORS_PREFIX)):
+            print(f"Skipping already handled file: {s3_key}")
+            continue
 
-            # Download file from S3 to Lambda's /tmp directory
-            local_file_path = f"/tmp/{os.path.basename(s3_key)}"
-            s3_client.download_file(s3_bucket, s3_key, local_file_path)
-            print(f"Downloaded {s3_key} to {local_file_path}")
-
-            # Send file to API
-            with open(local_file_path, "rb") as file_data:
-                files = {"file": (os.path.basename(s3_key), file_data, "text/csv")}
-                response = requests.post(f"{API_URL}", files=files)
-
-            # Handle API response
-            if response.status_code == 200:
-                print(f"File {s3_key} successfully sent to API. Response: {response.json()}")
-            else:
-                print(f"Failed to upload {s3_key}. API responded with: {response.text}")
-
-    except Exception as e:
-        print(f"Error processing file: {str(e)}")
-        return {
-            "statusCode": 500,
-            "body": json.dumps({"error": str(e)})
-        }
+        try:
+            totals = load_object(s3_bucket, s3_key)
+            target = move_object(s3_bucket, s3_key, PROCESSED_PREFIX)
+            print(f"File {s3_key} successfully sent to API and moved to {target}: {totals}")
+            results.append({"key": s3_key, "moved_to": target, **totals})
+        except Exception as e:
+            failed = True
+            print(f"Error processing file {s3_key}: {str(e)}")
+            try:
+                target = move_object(s3_bucket, s3_key, ERRORS_PREFIX)
+            except Exception as move_error:
+                print(f"Error moving {s3_key} to {ERRORS_PREFIX}: {move_error}")
+                target = None
+            results.append({"key": s3_key, "moved_to": target, "error": str(e)})
 
     return {
-        "statusCode": 200,
-        "body": json.dumps({"message": "Processing completed"})
+        "statusCode": 500 if failed else 200,
+        "body": json.dumps({"message": "Processing completed", "files": results})
     }
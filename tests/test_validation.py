@@ -0,0 +1,42 @@
+# tests/test_validation.py
+import os
+import sys
+from datetime import datetime
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+
+from services.validation import INT, ISO_DATETIME, STRING, ColumnSpec, parse_and_validate  # noqa: E402
+
+HIRED_EMPLOYEES_SPECS = [
+    ColumnSpec("id", INT),
+    ColumnSpec("name", STRING),
+    ColumnSpec("datetime", ISO_DATETIME, "hired_at"),
+    ColumnSpec("department_id", INT),
+    ColumnSpec("job_id", INT),
+]
+REFERENCES = {"department_id": np.arange(1, 13), "job_id": np.arange(1, 184)}
+
+
+def test_block_without_well_formed_rows_reports_errors():
+    row_count, valid, errors, _ = parse_and_validate(HIRED_EMPLOYEES_SPECS, "1,Bob\n2,Ann,x\n", REFERENCES)
+    assert row_count == 2
+    assert valid == []
+    assert errors == [
+        (0, ["1", "Bob"], "Expected 5 fields, got 2"),
+        (1, ["2", "Ann", "x"], "Expected 5 fields, got 3"),
+    ]
+
+
+def test_valid_row_gets_parsed_datetime():
+    _, valid, errors, _ = parse_and_validate(HIRED_EMPLOYEES_SPECS, "1, Bob ,2021-01-01T05:00:00+05:00,1,2\n", REFERENCES)
+    assert errors == []
+    assert valid == [(1, "Bob", "2021-01-01T05:00:00+05:00", 1, 2, datetime(2021, 1, 1, 0, 0))]
+
+
+def test_id_outside_int64_is_an_unknown_reference():
+    text = "1,Bob,2021-01-01T00:00:00Z,99999999999999999999,2\n2,Ann,2021-01-01T00:00:00Z,1,2\n"
+    _, valid, errors, _ = parse_and_validate(HIRED_EMPLOYEES_SPECS, text, REFERENCES)
+    assert [row[0] for row in valid] == [2]
+    assert [reason for _, _, reason in errors] == ["Unknown department_id: 99999999999999999999"]